@@ -1,5 +1,8 @@
 from maroon import *
 from tee import TeeDB
+from asyncdb import AsyncDB
+from buffered import BufferedDB, BufferedSaveError
+from pooled import PooledDB, PoolTimeout
 from mock import MockDB
 from maroondb import MaroonDB, ASCENDING, DESCENDING
 
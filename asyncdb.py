@@ -0,0 +1,74 @@
+'''
+maroon models - simplified object-relational mapper for Python and MongoDB
+by Jeremy Kelley <jeremy@33ad.org> and Jeff McGee <JeffAMcGee@gmail.com>
+'''
+
+from multiprocessing.pool import ThreadPool
+
+from maroondb import _prefetch
+
+
+#We do not extend MaroonDB because we want to call the methods in self._db
+class AsyncDB(object):
+    """Runs calls to db on a pool of worker threads so that they do not block
+    the caller.  The a* methods return a multiprocessing AsyncResult, which
+    has get(), wait() and ready(), except afind, which returns an iterator
+    that reads the results on a background thread.  Everything else is sent
+    to db as it is, so the synchronous Model methods still work:
+
+        Model.database = AsyncDB(MockDB())
+        pending = [Model.aget_id(_id) for _id in ids]
+        models = [p.get() for p in pending]
+    """
+    def __init__(self, db, workers=4, prefetch=100):
+        self._db = db
+        self._pool = ThreadPool(workers)
+        self._prefetch = prefetch
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+    def close(self):
+        "wait for the calls that were started and stop the worker threads"
+        self._pool.close()
+        self._pool.join()
+
+    def run(self, func, *args, **kwargs):
+        "call func(*args, **kwargs) on a worker thread"
+        return self._pool.apply_async(func, args, kwargs)
+
+    def asave(self, model):
+        return self.run(self._db.save, model)
+
+    def amerge(self, model):
+        return self.run(self._db.merge, model)
+
+    def abulk_save_models(self, models, cls=None, **kwargs):
+        return self.run(self._db.bulk_save_models, models, cls, **kwargs)
+
+    def adelete_id(self, name, _id):
+        return self.run(self._db.delete_id, name, _id)
+
+    def aget_id(self, cls, _id, **kwargs):
+        return self.run(self._db.get_id, cls, _id, **kwargs)
+
+    def ain_coll(self, cls, _id):
+        return self.run(self._db.in_coll, cls, _id)
+
+    def afind(self, cls, q=None, prefetch=None, **kwargs):
+        """Run the query on a background thread, which reads up to prefetch
+        objects ahead of the caller."""
+        if prefetch is None:
+            prefetch = self._prefetch
+        return _prefetch(self._find(cls, q, **kwargs), max(prefetch,1))
+
+    def _find(self, cls, q, **kwargs):
+        #a generator, so that the query is sent from the background thread
+        for obj in self._db.find(cls, q, **kwargs):
+            yield obj
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
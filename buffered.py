@@ -0,0 +1,164 @@
+'''
+maroon models - simplified object-relational mapper for Python and MongoDB
+by Jeremy Kelley <jeremy@33ad.org> and Jeff McGee <JeffAMcGee@gmail.com>
+'''
+
+import time
+
+
+class BufferedSaveError(Exception):
+    "errors is a list of (model or id, exception) for the writes that failed"
+    def __init__(self, errors):
+        Exception.__init__(self, "%d buffered writes failed"%len(errors))
+        self.errors = errors
+
+
+#We do not extend MaroonDB because we want to call the methods in self._db
+class BufferedDB(object):
+    """Collects save, merge and delete calls and sends them to db when size
+    writes are waiting, or when a write comes in interval seconds or more
+    after the oldest waiting one.  There is no background thread, so writes
+    can wait longer than interval if nothing else is written; call flush()
+    to send them.  Runs of saves are sent with bulk_save_models.  Reading
+    from the database sends the waiting writes first.  Use it as a context
+    manager to flush on exit.  Saves and merges send a copy of the model
+    as it was when they were called, and a saved model is only marked clean
+    once it has been written:
+
+        with BufferedDB(db) as Model.database:
+            for d in docs:
+                Model(d).save()
+    """
+    #Model.save() leaves marking the model clean to flush()
+    queues_writes = True
+
+    def __init__(self, db, size=1000, interval=None, clock=time.time):
+        self._db = db
+        self._size = size
+        self._interval = interval
+        self._clock = clock
+        self._ops = []
+        self._started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is None:
+            self.flush()
+        else:
+            #do not hide the original exception
+            try:
+                self.flush()
+            except BufferedSaveError:
+                pass
+
+    def _add(self, op):
+        if not self._ops:
+            self._started = self._clock()
+        self._ops.append(op)
+        if len(self._ops)>=self._size:
+            self.flush()
+        elif self._interval is not None:
+            if self._clock()-self._started>=self._interval:
+                self.flush()
+
+    def save(self, model):
+        self._add(('save', _Pending(model)))
+        return model
+
+    def bulk_save_models(self, models, cls=None, **kwargs):
+        for model in models:
+            self._add(('save', _Pending(model)))
+
+    def merge(self, model):
+        self._add(('merge', _Pending(model)))
+
+    def delete_id(self, name, _id):
+        self._add(('delete', (name, _id)))
+
+    def flush(self):
+        """send the waiting writes to the database.  Raises BufferedSaveError
+        after trying all of them if any failed."""
+        ops, self._ops = self._ops, []
+        errors = []
+        run = []
+        for kind,arg in ops:
+            if kind=='save':
+                if run and run[0].kind is not arg.kind:
+                    errors.extend(self._save_run(run))
+                    run = []
+                run.append(arg)
+                continue
+            errors.extend(self._save_run(run))
+            run = []
+            try:
+                if kind=='merge':
+                    self._db.merge(arg.copy)
+                    arg.written(False)
+                else:
+                    self._db.delete_id(*arg)
+            except Exception, e:
+                errors.append((arg.model if kind=='merge' else arg, e))
+        errors.extend(self._save_run(run))
+        if errors:
+            raise BufferedSaveError(errors)
+
+    def _save_run(self, pending):
+        "save models of the same class, returns a list of errors"
+        if not pending:
+            return []
+        try:
+            self._db.bulk_save_models(
+                [p.copy for p in pending], pending[0].kind)
+        except Exception:
+            pass
+        else:
+            for p in pending:
+                p.written(True)
+            return []
+        #find out which documents failed
+        errors = []
+        for p in pending:
+            try:
+                self._db.save(p.copy)
+            except Exception, e:
+                errors.append((p.model, e))
+            else:
+                p.written(True)
+        return errors
+
+    def __getattr__(self, name):
+        if self.__dict__.get('_ops'):
+            self.flush()
+        return getattr(self._db, name)
+
+
+class _Pending(object):
+    "a model waiting to be written, and a copy of how it looked back then"
+    def __init__(self, model):
+        self.model = model
+        self.kind = model.__class__
+        self.doc = model.to_d(dateformat="datetime")
+        #only the fields in doc, so that fields set to None stay None
+        names = self.kind.long_names
+        self.copy = self.kind.from_db(self.doc,
+            fields=set(names.get(k,k) for k in self.doc))
+        #but it is only partial if the model is
+        partial = model.__dict__.get('_partial')
+        if partial is None:
+            del self.copy.__dict__['_partial']
+        else:
+            self.copy.__dict__['_partial'] = partial
+
+    def written(self, saved):
+        """copy the ids the database gave the copy back to the model, and if
+        it was saved and has not changed since, mark it clean"""
+        model = self.model
+        ids = {}
+        for name in ('_id','_rev'):
+            val = getattr(self.copy, name, None)
+            if val is not None:
+                model.__dict__[name] = ids[name] = val
+        if saved and model.to_d(dateformat="datetime")==dict(self.doc,**ids):
+            model.mark_clean()
@@ -1,9 +1,24 @@
+from functools import partial
+
 import couchdbkit
 from couchdbkit import Database, ResourceNotFound
-from maroondb import MaroonDB
+from maroon import BogusQuery
+from maroondb import MaroonDB, _chunks, _pipeline, _projection
+from maroondb import _interleave, _prefetch, _project, _ranges
 
 
 class CouchDB(Database,MaroonDB):
+    def __init__(self, uri, create=False, verify=False, **kwargs):
+        Database.__init__(self, uri, create, **kwargs)
+        self.verify = verify
+
+    def healthy(self):
+        try:
+            self.info()
+            return True
+        except Exception:
+            return False
+
     def save(self, model):
         d = model.to_d()
         self.save_doc(d)
@@ -11,40 +26,130 @@ class CouchDB(Database,MaroonDB):
         model._rev = d['_rev'] # save the unique id from couchdb
         return model
 
-    def bulk_save_models(self, models):
-        ds = []
-        for m in models:
-            d = m.to_d()
-            ds.append(d)
-        self.bulk_save(ds)
+    def bulk_save_models(self, models, cls=None, chunk_size=1000,
+            ordered=True, workers=1):
+        """Save models chunk_size at a time, with up to workers requests
+        running at once.  If ordered is False, chunks after a failed one
+        are still sent, and the first error is raised at the end.  If it is
+        True, the chunks are sent one at a time so that nothing after a
+        failed chunk is saved, and workers is ignored.  The _id and _rev of
+        each saved model are updated."""
+        if ordered:
+            workers = 1
+        def save(chunk):
+            ds = (cls or chunk[0].__class__).to_dicts(chunk)
+            try:
+                self.bulk_save(ds)
+            except Exception, e:
+                if ordered:
+                    raise
+                return e
+            finally:
+                for m,d in zip(chunk,ds):
+                    if '_rev' in d:
+                        m._id, m._rev = d['_id'], d['_rev']
+        errors = [ e for e in
+            _pipeline(save, _chunks(models, chunk_size), workers)
+            if e is not None ]
+        if errors:
+            raise errors[0]
+
+    def update_changed(self, model):
+        changed = model.changed()
+        if changed is not None and not changed:
+            return
+        if model._rev is None or model.__dict__.get('_partial') is not None:
+            return MaroonDB.update_changed(self, model)
+        #couch replaces the whole document, and we already have all of it
+        return self.save(model)
 
-    def get_id(self, cls, _id, **kwargs):
+    def get_id(self, cls, _id, fields=None, **kwargs):
+        names, fields = _projection(cls, fields)
         try:
             d = self.open_doc(_id, **kwargs)
-            return cls(d)
+            if names:
+                d = _project(d, names)
+            return self._load(cls,d,fields=fields)
         except ResourceNotFound:
             return None
 
-    def get_all(self, cls, limit=None):
-        for doc in self.paged_view('_all_docs',include_docs=True,limit=limit):
+    def get_ids(self, cls, ids, lazy=False, **kwargs):
+        "fetch all of the documents with one request to _all_docs"
+        res = self.view('_all_docs', keys=list(ids), include_docs=True)
+        for row in res:
+            if row.get('doc') is not None:
+                yield self._load(cls,row['doc'],lazy)
+
+    def get_all(self, cls, limit=None, lazy=False, fields=None, prefetch=0):
+        names, fields = _projection(cls, fields)
+        docs = self.paged_view('_all_docs', include_docs=True, limit=limit,
+                prefetch=prefetch)
+        for doc in docs:
             if doc['id'][0]!='_':
-                yield cls(doc['doc'])
+                d = _project(doc['doc'], names) if names else doc['doc']
+                yield self._load(cls,d,lazy,fields)
+
+    def parallel_scan(self, cls, q=None, workers=4, lazy=False, fields=None,
+            page_size=1000):
+        """Split _all_docs into workers ranges of keys and page through them
+        at the same time.  Objects are yielded in the order they arrive."""
+        if q:
+            raise BogusQuery("CouchDB can't parallel_scan a query")
+        names, fields = _projection(cls, fields)
+        count = self.info()['doc_count']
+        splits = []
+        for i in xrange(1, workers):
+            for row in self.view('_all_docs', skip=count*i//workers, limit=1):
+                if not splits or splits[-1]!=row['key']:
+                    splits.append(row['key'])
+        def scan(start, end):
+            params = dict(include_docs=True, page_size=page_size)
+            if start is not None:
+                params['startkey'] = start
+            if end is not None:
+                params.update(endkey=end, inclusive_end=False)
+            for doc in self.paged_view('_all_docs', **params):
+                if doc['id'][0]!='_':
+                    d = _project(doc['doc'], names) if names else doc['doc']
+                    yield self._load(cls,d,lazy,fields)
+        return _interleave(
+            [partial(scan, *r) for r in _ranges(splits)], workers)
+
+    def find_docs(self, cls, q=None, limit=None, fields=None, prefetch=0):
+        "only works like get_all, since couch can not run queries"
+        if q:
+            raise BogusQuery("CouchDB can't find_docs with a query")
+        names = _projection(cls, fields)[0]
+        docs = self.paged_view('_all_docs', include_docs=True, limit=limit,
+                prefetch=prefetch)
+        for doc in docs:
+            if doc['id'][0]!='_':
+                yield _project(doc['doc'], names) if names else doc['doc']
+
+    def paged_view(self, view_name, page_size=1000, cls=None, lazy=False,
+            prefetch=0, **params):
+        """Iterate over a view page_size rows at a time.  If prefetch is set,
+        a background thread fetches up to that many pages ahead while the
+        current page is read."""
+        if cls:
+            params['include_docs']=True
+        pages = _prefetch(self._pages(view_name, page_size, params), prefetch)
+        for page in pages:
+            for r in page:
+                if cls:
+                    yield self._load(cls,r['doc'],lazy)
+                else:
+                    yield r
 
-    def paged_view(self, view_name, page_size=1000, cls=None, **params):
+    def _pages(self, view_name, page_size, params):
         orig_limit = params.get('limit',None)
         yielded = 0
         params['limit']=page_size+1
-        if cls:
-            params['include_docs']=True
         while True:
             if orig_limit is not None:
                 params['limit']=min(orig_limit-yielded,page_size+1)
             res = list(self.view(view_name, **params))
-            for r in res[0:page_size]:
-                if cls:
-                    yield cls(r['doc'])
-                else:
-                    yield r
+            yield res[0:page_size]
             if len(res) != page_size+1:
                 break
             yielded +=page_size
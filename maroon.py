@@ -5,9 +5,15 @@ by Jeremy Kelley <jeremy@33ad.org> and Jeff McGee <JeffAMcGee@gmail.com>
 
 import calendar
 from datetime import datetime as _dt
-from collections import defaultdict
+from collections import defaultdict, MutableMapping, OrderedDict
 from copy import copy
+from itertools import islice
+from multiprocessing.pool import ThreadPool
+import operator
 import re
+import sys
+import time
+import threading
 import pprint
 
 
@@ -17,32 +23,41 @@ SLUG_REGEX = re.compile('[\w@\.]+$')
 class BogusQuery(Exception): pass
 
 
+class PartialModelError(Exception): pass
+
+
 class Q(dict):
-    def __init__(self, d=None):
-        dict.__init__(self,d)
+    def __init__(self, d=None, scalars=()):
+        dict.__init__(self,d or {})
+        #the fields that can't hold a list, so no object has two values
+        self.scalars = frozenset(scalars).union(getattr(d,'scalars',()))
 
     def __and__(self, v):
         for key in set(self)&set(v):
-            if key != '$or':
+            if key != '$or' and self[key] != v[key]:
                 raise BogusQuery( "field %s can't match %s and %s"%(
                         key, str(self[key]), str(v[key])
                     ))
-        q = Q(self) #we do not want to modify self or v
+        #we do not want to modify self or v
+        q = Q(self, getattr(v,'scalars',()))
         q.update(v)
         if self.has_key('$or') and v.has_key('$or'):
             #combine the things in $or using the distributive property
-            #(a|b)&(c|d) -> (a&c | a&d | b&c | b&d)
-            q['$or'] = [
-                self_term & v_term
+            #(a|b)&(c|d) -> (a&c | a&d | b&c | b&d), skipping the products
+            #that can't match anything
+            del q['$or']
+            products = (
+                _combine(self_term, v_term, q.scalars)
                 for self_term in self['$or']
                 for v_term in v['$or']
-            ]
+            )
+            return q & _any_of([p for p in products if p is not None])
         return q
 
     def __or__(self, v):
         fixed_self = self._to_distributed_list()
         fixed_v = v._to_distributed_list()
-        return Q({'$or':fixed_self+fixed_v})
+        return _any_of(fixed_self+fixed_v)
 
     def _to_distributed_list(self):
         #returns a list of Q objects that is equivalent to self if the terms
@@ -55,21 +70,17 @@ class Q(dict):
         del outer['$or']
         #mongo does not let you nest or statements - use boolean algebra to
         #return a "sum of products"
-        return [ (outer & inner) for inner in self['$or']]
+        products = (_combine(outer, inner, self.scalars)
+                for inner in self['$or'])
+        return [p for p in products if p is not None]
 
     def to_mongo_dict(self):
-        "take the query and turn it into a mongo-style dictionary"
+        """take the query and turn it into a mongo-style dictionary.  This is
+        one pass over the query, which is cheaper than finding its shape to
+        look up a cached plan, so nothing is cached here.  MockDB caches its
+        compiled predicates by shape, since compiling one costs far more."""
         d = defaultdict(dict)
         for key,val in self.iteritems():
-            #crawl the tree
-            if isinstance(val, list):
-                mongo_value = [
-                        item.to_mongo_dict() if isinstance(item,Q) else item
-                        for item in val
-                ]
-            else:
-                mongo_value = val
-
             #expand the tuples
             if isinstance(key, tuple):
                 if key[0] in self:
@@ -77,13 +88,209 @@ class Q(dict):
                             key[0], str(self[key[0]]), str(val)
                         ))
                 #convert self[('size','$gte')] to d['size']['$gte']
-                d[key[0]][key[1]] = mongo_value
+                d[key[0]][key[1]] = val
+            elif key=='$or':
+                #crawl the tree
+                d[key] = [
+                        item.to_mongo_dict() if isinstance(item,Q) else item
+                        for item in val
+                ]
             else:
-                d[key] = mongo_value
+                d[key] = val
         return d
 
 
+_lower = {'$gt':operator.gt, '$gte':operator.ge}
+_upper = {'$lt':operator.lt, '$lte':operator.le}
+
+
+def _combine(a, b, scalars):
+    """a&b for two terms of an $or, or None if no object can match both.
+    Only terms that are provably contradictory are dropped: two different
+    equalities, an equality outside of a bound, or an empty range on one of
+    the fields in scalars.  A list field can hold both values, so those go
+    through Q.__and__, which may raise BogusQuery.  An equality that is
+    inside of the bounds on its field replaces them."""
+    eqs, bounds = {}, defaultdict(list)
+    for term in (a, b):
+        for key,val in term.iteritems():
+            if isinstance(key, tuple):
+                if key[1] in _lower or key[1] in _upper:
+                    bounds[key[0]].append((key[1], val))
+            elif key!='$or' and _is_value(val):
+                if key in eqs and eqs[key]!=val and key in scalars:
+                    return None
+                eqs[key] = val
+    for field,ranges in bounds.iteritems():
+        if field not in scalars:
+            continue
+        for op,val in ranges:
+            if field in eqs:
+                if _comparable(eqs[field], val) and \
+                        not _lower.get(op, _upper.get(op))(eqs[field], val):
+                    return None
+            elif op in _lower:
+                for high_op,high in ranges:
+                    if high_op in _upper and _comparable(val, high):
+                        if val>high or (val==high and
+                                (op=='$gt' or high_op=='$lt')):
+                            return None
+    q = a & b
+    q.scalars = q.scalars.union(scalars)
+    for field,ranges in bounds.iteritems():
+        if field in eqs and all(_comparable(eqs[field], val) and
+                _lower.get(op, _upper.get(op))(eqs[field], val)
+                for op,val in ranges):
+            for op,val in ranges:
+                q.pop((field,op),None)
+    return q
+
+
+def _is_value(val):
+    "is val something an equality matches exactly?"
+    return val is not None and not hasattr(val,'search') \
+            and not isinstance(val, (list,tuple,dict))
+
+
+def _comparable(a, b):
+    "can a and b be ordered the way mongo would order them?"
+    numbers = (int,long,float)
+    if isinstance(a, numbers):
+        return isinstance(b, numbers) and not isinstance(b, bool) \
+                and not isinstance(a, bool)
+    if isinstance(a, basestring):
+        return isinstance(b, basestring)
+    return isinstance(a, _dt) and isinstance(b, _dt)
+
+
+def _any_of(terms):
+    """OR terms together after removing duplicates and folding equalities on
+    the same field into $in, so that distributing the result stays small"""
+    scalars = frozenset().union(*(getattr(t,'scalars',()) for t in terms))
+    terms = _fold_in(_unique(terms))
+    if not terms:
+        raise BogusQuery("The query can't match anything.")
+    if len(terms)==1:
+        return Q(terms[0], scalars)
+    if not all(terms):
+        #an empty term matches everything
+        return Q({})
+    return Q({'$or':terms}, scalars)
+
+
+def _freeze(val):
+    if isinstance(val, dict):
+        return tuple(sorted((k,_freeze(v)) for k,v in val.iteritems()))
+    if isinstance(val, (list,tuple)):
+        return tuple(_freeze(v) for v in val)
+    if hasattr(val, 'pattern'):
+        return ('$regex', val.pattern, val.flags)
+    return val
+
+
+def _unique(terms):
+    seen = set()
+    ret = []
+    for term in terms:
+        try:
+            key = _freeze(term)
+            if key in seen:
+                continue
+            seen.add(key)
+        except TypeError:
+            pass #unhashable values are never treated as duplicates
+        ret.append(term)
+    return ret
+
+
+def _in_values(term):
+    "returns (field, values) if term only checks that field is in values"
+    if len(term)!=1:
+        return None, None
+    key, val = term.items()[0]
+    if isinstance(key, tuple):
+        if key[1]=='$in' and isinstance(val, list):
+            return key[0], val
+    elif key!='$or' and _is_value(val):
+        return key, [val]
+    return None, None
+
+
+def _fold_in(terms):
+    ret = []
+    groups = {} #field -> (position in ret, values, number of terms)
+    for term in terms:
+        field, vals = _in_values(term)
+        if field is None:
+            ret.append(term)
+            continue
+        if field not in groups:
+            groups[field] = (len(ret), [], 0)
+            ret.append(term)
+        pos, found, count = groups[field]
+        found.extend(vals)
+        groups[field] = (pos, found, count+1)
+    for field,(pos,found,count) in groups.iteritems():
+        if count>1:
+            ret[pos] = Q({(field,'$in'):_unique(found)})
+    return ret
+
+
+class U(dict):
+    """An atomic update for the objects that match a query.  The keys are
+    (operator, short name) and the values are (Property, value)."""
+    def __and__(self, v):
+        names = set(name for op,name in self)
+        for op,name in v:
+            if name in names:
+                raise BogusQuery("field %s can't be updated twice"%name)
+        u = U(self) #we do not want to modify self or v
+        u.update(v)
+        return u
+
+    def to_mongo_dict(self, **kwargs):
+        """turn the update into a mongo-style dictionary, kwargs are passed
+        to Property.to_d"""
+        d = defaultdict(dict)
+        for (op,name),(prop,val) in self.iteritems():
+            if op=='$set':
+                val = prop.to_d(val, **kwargs)
+            elif op=='$unset':
+                val = 1
+            elif op in ('$push','$addToSet'):
+                val = {'$each':prop.to_d(val, **kwargs)}
+            elif op=='$pullAll':
+                val = prop.to_d(val, **kwargs)
+            d[op][name] = val
+        return dict(d)
+
+    def apply(self, obj):
+        "change obj the way the database would change the document"
+        for (op,name),(prop,val) in self.iteritems():
+            attr = obj.long_names[name]
+            old = getattr(obj, attr, None)
+            if op=='$set':
+                setattr(obj, attr, val)
+            elif op=='$unset':
+                setattr(obj, attr, None)
+            elif op=='$inc':
+                setattr(obj, attr, (old or 0)+val)
+            elif old is None:
+                if op!='$pullAll':
+                    setattr(obj, attr, val)
+            elif op=='$push':
+                old.extend(val)
+            elif op=='$addToSet':
+                old.extend(x for x in val if x not in old)
+            elif op=='$pullAll':
+                old[:] = [x for x in old if x not in val]
+
+
 class Property(object):
+    #True if the field never holds a list, so an object can't match two
+    #different equalities on it
+    scalar = False
+
     def __init__(self, name, default=None, null=True):
         self.name = name or None
         if default is not None:
@@ -105,6 +312,26 @@ class Property(object):
         "Changes val into something that can go to json.dumps"
         return val
 
+    def to_d_column(self, vals, **kwargs):
+        """to_d for a list of values from many objects.  Subclasses override
+        this if they can convert the whole list at once."""
+        if type(self).to_d.im_func is Property.to_d.im_func:
+            return vals
+        return [self.to_d(val, **kwargs) for val in vals]
+
+    def from_db(self, val):
+        """Inverse of to_d for values that were validated before they were
+        saved.  Subclasses only override this if the stored form is not
+        already the python form."""
+        return val
+
+    def __get__(self, obj, cls):
+        #only called when obj.__dict__ does not have the field, which only
+        #happens for fields that from_db(lazy=True) has not decoded yet
+        if obj is None:
+            return self
+        return obj._load_lazy(self)
+
     def __repr__(self):
         default = self.default()
         if default is None:
@@ -112,16 +339,27 @@ class Property(object):
         else:
             return "%s(%r,%r)"%(self.__class__.__name__,self.name,default)
 
-    def __eq__(self, v): return Q({self.name: v})
-    def __ge__(self, v): return Q({(self.name, '$gte'):v})
-    def __gt__(self, v): return Q({(self.name, '$gt' ):v})
-    def __le__(self, v): return Q({(self.name, '$lte'):v})
-    def __lt__(self, v): return Q({(self.name, '$lt' ):v})
-    def __ne__(self, v): return Q({(self.name, '$ne' ):v})
+    def _q(self, d):
+        return Q(d, (self.name,) if self.scalar else ())
+
+    def __eq__(self, v): return self._q({self.name: v})
+    def __ge__(self, v): return self._q({(self.name, '$gte'):v})
+    def __gt__(self, v): return self._q({(self.name, '$gt' ):v})
+    def __le__(self, v): return self._q({(self.name, '$lte'):v})
+    def __lt__(self, v): return self._q({(self.name, '$lt' ):v})
+    def __ne__(self, v): return self._q({(self.name, '$ne' ):v})
 
-    def is_in(self, terms): return Q({(self.name, '$in' ):terms})
-    def is_not_in(self, terms): return Q({(self.name, '$nin' ):terms})
-    def exists(self,exists=True): return Q({(self.name, '$exists' ):exists})
+    def is_in(self, terms): return self._q({(self.name, '$in' ):terms})
+    def is_not_in(self, terms): return self._q({(self.name, '$nin' ):terms})
+    def exists(self,exists=True):
+        return self._q({(self.name, '$exists' ):exists})
+
+    def set(self, v):
+        if v is None:
+            return self.unset()
+        return U({('$set', self.name): (self, self.validated(v))})
+    def unset(self): return U({('$unset', self.name): (self, None)})
+    def inc(self, amount=1): return U({('$inc', self.name): (self, amount)})
 
     def range(self, start=None, end=None):
         "create a query to find objects where start<=val<end"
@@ -135,6 +373,8 @@ class Property(object):
 
 
 class EnumProperty(Property):
+    scalar = True
+
     def __init__(self, name, constants, **kwargs):
         Property.__init__(self, name, **kwargs)
         self.constants = constants
@@ -155,16 +395,22 @@ class TypedProperty(Property):
         return self.kind(Property.validated(self, val))
 
 class BoolProperty(TypedProperty):
+    scalar = True
+
     def  __init__(self, name, **kwargs):
         TypedProperty.__init__(self, name, bool, **kwargs)
 
 
 class IntProperty(TypedProperty):
+    scalar = True
+
     def  __init__(self, name, **kwargs):
         TypedProperty.__init__(self, name, int, **kwargs)
 
 
 class FloatProperty(TypedProperty):
+    scalar = True
+
     def  __init__(self, name, **kwargs):
         TypedProperty.__init__(self, name, float, **kwargs)
 
@@ -206,10 +452,29 @@ class DateTimeProperty(Property):
         else:
             return val.strftime(format)
 
+    def to_d_column(self, vals, **kwargs):
+        format = kwargs.get('dateformat',None)
+        if format=="datetime":
+            return vals
+        elif format=="epoch":
+            timegm = calendar.timegm
+            return [timegm(val.timetuple()) for val in vals]
+        elif format in (None,"list"):
+            return [val.timetuple()[0:6] for val in vals]
+        else:
+            return [val.strftime(format) for val in vals]
+
+    def from_db(self, val):
+        if isinstance(val,_dt):
+            return val
+        return self.validated(val)
+
 
 class TextProperty(Property):
     """TextProperty needs to work correctly with Unicode and String objects.
     That is the reason this is not a subclass of TypedProperty."""
+    scalar = True
+
     def validated(self, val):
         val = Property.validated(self, val)
         if not isinstance(val, basestring):
@@ -217,11 +482,11 @@ class TextProperty(Property):
         return val
 
     def __floordiv__(self, pattern):
-        return Q({self.name: re.compile(pattern)})
+        return self._q({self.name: re.compile(pattern)})
 
 
 class IdProperty(Property):
-    pass
+    scalar = True
 
 
 class RegexTextProperty(TextProperty):
@@ -258,6 +523,8 @@ class CreatedAtProperty(DateTimeProperty):
 class ListPropertyInstance(list):
     def __init__(self, property):
         self.property = property
+        #set when the list is changed, so the model knows to save it
+        self.dirty = False
 
     def __setslice__(self,i,j,seq):
         self.__setitem__(slice(i,j),seq)
@@ -268,9 +535,23 @@ class ListPropertyInstance(list):
                 self.property.validated_item(obj)
         else:
             self.property.validated_item(value)
+        self.dirty = True
         list.__setitem__(self, key, value)
 
 
+def _marks_dirty(name):
+    method = getattr(list, name)
+    def mark(self, *args, **kwargs):
+        self.dirty = True
+        return method(self, *args, **kwargs)
+    mark.__name__ = name
+    return mark
+
+for _name in ('append', 'extend', 'insert', 'pop', 'remove', 'reverse',
+        'sort', '__delitem__', '__delslice__', '__iadd__', '__imul__'):
+    setattr(ListPropertyInstance, _name, _marks_dirty(_name))
+
+
 class ListProperty(Property):
     def __init__(self, name, kind=None, **kwargs):
         Property.__init__(self, name, **kwargs)
@@ -279,7 +560,7 @@ class ListProperty(Property):
     def validated(self, val):
         val = Property.validated(self, val)
         ret = ListPropertyInstance(self)
-        ret.extend((self.validated_item(v) for v in val))
+        list.extend(ret, (self.validated_item(v) for v in val))
         return ret
 
     def validated_item(self, val):
@@ -287,8 +568,22 @@ class ListProperty(Property):
             raise TypeError("%s in list is not a %s"%(val,self._kind.__name__))
         return val
 
+    def from_db(self, val):
+        ret = ListPropertyInstance(self)
+        list.extend(ret, val)
+        return ret
+
     def has_all(self, terms): return Q({(self.name, '$all' ):terms})
 
+    def _items(self, op, items):
+        ret = ListPropertyInstance(self)
+        list.extend(ret, (self.validated_item(v) for v in items))
+        return U({(op, self.name): (self, ret)})
+
+    def push(self, *items): return self._items('$push', items)
+    def add_to_set(self, *items): return self._items('$addToSet', items)
+    def pull(self, *items): return self._items('$pullAll', items)
+
 
 class SlugListProperty(ListProperty):
     def __init__(self, name, **kwargs):
@@ -302,7 +597,129 @@ class SlugListProperty(ListProperty):
         return val
 
 
+class _RawDoc(dict):
+    """The undecoded fields of a lazy model, keyed by long name.  kwargs are
+    the arguments to to_d that produced the values."""
+    def __init__(self, kwargs):
+        dict.__init__(self)
+        self.kwargs = kwargs
+
+
+class _SlotDict(MutableMapping):
+    """Stands in for the __dict__ of a compact model.  Fields live in slots,
+    anything else goes in the _extra slot."""
+    __slots__ = ('obj','members')
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.members = type(obj)._slot_members
+
+    def _extra(self, create=False):
+        try:
+            extra = self.obj._extra
+        except AttributeError:
+            extra = None
+        if extra is None:
+            if not create:
+                return {}
+            extra = {}
+            #skip ModelPart.__setattr__, which would come back here
+            object.__setattr__(self.obj, '_extra', extra)
+        return extra
+
+    def __getitem__(self, key):
+        member = self.members.get(key)
+        if member is None:
+            return self._extra()[key]
+        try:
+            return member.__get__(self.obj)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        member = self.members.get(key)
+        if member is None:
+            self._extra(True)[key] = val
+        else:
+            member.__set__(self.obj, val)
+
+    def __delitem__(self, key):
+        member = self.members.get(key)
+        if member is None:
+            del self._extra()[key]
+            return
+        try:
+            member.__delete__(self.obj)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __iter__(self):
+        obj = self.obj
+        for name,member in self.members.iteritems():
+            try:
+                member.__get__(obj)
+            except AttributeError:
+                continue
+            yield name
+        for name in self._extra().keys():
+            yield name
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+
+class _CompactStorage(object):
+    "Mixin that ModelMetaclass adds to models that set compact = True"
+    __slots__ = ()
+
+    @property
+    def __dict__(self):
+        return _SlotDict(self)
+
+    def __getattr__(self, n):
+        #only called for attributes that are not fields
+        try:
+            extra = None if n=='_extra' else self._extra
+        except AttributeError:
+            extra = None
+        if extra is None or n not in extra:
+            raise AttributeError(n)
+        return extra[n]
+
+    def __getstate__(self):
+        return dict(self.__dict__.iteritems())
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def _load_lazy(self, prop):
+        name = self.long_names[prop.name]
+        try:
+            return self._slot_members[name].__get__(self)
+        except AttributeError:
+            return ModelPart._load_lazy(self, prop)
+
+
 class ModelMetaclass(type):
+    def __new__(meta, name, bases, d):
+        compact = d.get('compact', any(getattr(b,'compact',False) for b in bases))
+        if compact and '__slots__' not in d:
+            #store the fields in slots instead of a dict per instance
+            names = set(k for k,v in d.iteritems() if isinstance(v,Property))
+            have = set(['_extra'])
+            for base in bases:
+                names.update(getattr(base,'long_names',{}).itervalues())
+                have.update(getattr(base,'_slot_members',{}))
+            d = dict(d)
+            d['__slots__'] = tuple(
+                    '_s_'+n for n in sorted(names) if n not in have)
+            if not any(issubclass(b,_CompactStorage) for b in bases):
+                #the bookkeeping in ModelPart._internal gets slots too, so
+                #loading an object does not make an _extra dict for it
+                d['__slots__'] += ('_extra','_dirty','_partial','_raw')
+                bases = (_CompactStorage,)+bases
+        return type.__new__(meta, name, bases, d)
+
     def __init__(cls, name, bases, d):
         type.__init__(cls,name, bases, d)
         cls.update_long_names()
@@ -310,26 +727,50 @@ class ModelMetaclass(type):
 
 class ModelPart(object):
     __metaclass__=ModelMetaclass
+    #subclasses get a __dict__ unless they are compact
+    __slots__ = ()
     ignored = ()
+    #set compact to True in a model to keep its fields in __slots__
+    compact = False
     long_names = {}
+    _validators = {}
+    _plan = {}
+    _defaults = ()
+    _loaders = {}
+    #names in __dict__ that hold bookkeeping instead of fields.  _dirty is
+    #None for new objects, which are not tracked, the set of changed fields
+    #for loaded objects, and missing until a loaded object changes.
+    _internal = frozenset(['_raw','_partial','_dirty'])
+
+    def __new__(cls, *args, **kwargs):
+        #ModelPart and Model have no __dict__ so that compact models can do
+        #without one, so their own instances come from a plain subclass
+        return object.__new__(_plain.get(cls, cls))
 
     def __init__(self, from_dict=None, **kwargs):
+        d = self.__dict__
+        d['_dirty'] = None
         if from_dict:
             self.update(from_dict)
         self.update(kwargs)
 
         #set defaults
-        for name in self.long_names.values():
-            if name not in self.__dict__:
-                prop = getattr(type(self),name)
-                self.__dict__[name] = prop.default()
+        for name,default in self._defaults:
+            if name not in d:
+                d[name] = default()
 
     def __setattr__(self, n, v):
-        field = getattr(type(self),n,None)
-        if field and isinstance(field, Property):
-            if v is not None:
-                v = field.validated(v)
-        self.__dict__[n] = v
+        if v is not None:
+            validated = self._validators.get(n)
+            if validated:
+                v = validated(v)
+        sd = self.__dict__
+        sd[n] = v
+        dirty = sd.get('_dirty',())
+        if dirty is not None:
+            if not dirty:
+                dirty = sd['_dirty'] = set()
+            dirty.add(n)
 
     def __repr__(self):
         d = pprint.pformat(self.to_d())
@@ -342,13 +783,49 @@ class ModelPart(object):
             prop = getattr(cls,name)
             if isinstance(prop, Property):
                 cls.long_names[prop.name] = name
+        cls._compile_plan()
+
+    @classmethod
+    def _compile_plan(cls):
+        """Build the per-class tables used to hydrate and validate instances.
+        _plan maps both long and short names to (long name, validator), so
+        update() does not have to search the MRO for every key."""
+        props = dict(
+            (name, getattr(cls,name))
+            for name in cls.long_names.itervalues()
+            )
+        cls._validators = dict(
+            (name, prop.validated) for name,prop in props.iteritems()
+            )
+        cls._plan = dict(
+            (name, (name, prop.validated)) for name,prop in props.iteritems()
+            )
+        #short names win, just like long_names.get(k,k) does
+        for short,name in cls.long_names.iteritems():
+            cls._plan[short] = (name, props[name].validated)
+        cls._defaults = tuple(
+            (name, prop.default) for name,prop in props.iteritems()
+            )
+        cls._loaders = dict(
+            (name, (name, prop.from_db)) for name,prop in props.iteritems()
+            )
+        for short,name in cls.long_names.iteritems():
+            cls._loaders[short] = (name, props[name].from_db)
+        if cls.compact:
+            cls._slot_members = dict(
+                (name, getattr(cls,'_s_'+name)) for name in props
+                )
+            for name in cls._internal:
+                cls._slot_members[name] = getattr(cls,name)
 
     def to_d(self, **kwargs):
         'Build a dictionary from all the properties attached to self.'
         d = dict()
         model = type(self)
-        for name,val in self.__dict__.iteritems():
-            if val is None or name in self.ignored: continue
+        sd = self.__dict__
+        for name,val in sd.iteritems():
+            if val is None or name in self.ignored or name in self._internal:
+                continue
             prop = getattr(model,name,None)
             if isinstance(prop, Property):
                 key = name if kwargs.get('long_names') else prop.name
@@ -358,13 +835,193 @@ class ModelPart(object):
                     d[name]=val.to_d()
                 except AttributeError:
                     d[name]=val
+        raw = sd.get('_raw')
+        if raw:
+            #fields nobody looked at can be copied without decoding them
+            reuse = raw.kwargs==kwargs
+            for name,val in raw.items():
+                if val is None or name in sd or name in self.ignored:
+                    continue
+                prop = getattr(model,name)
+                key = name if kwargs.get('long_names') else prop.name
+                if reuse:
+                    d[key] = val
+                else:
+                    d[key] = prop.to_d(getattr(self,name), **kwargs)
         return d
 
+    @classmethod
+    def to_dicts(cls, models, **kwargs):
+        """Returns [m.to_d(**kwargs) for m in models], but the properties are
+        looked up once for the whole list, and each field is converted as a
+        column with Property.to_d_column."""
+        skip = cls._internal.union(cls.ignored)
+        props = cls._validators
+        ds, batch = [], []
+        for model in models:
+            sd = model.__dict__
+            if type(model) is not cls or sd.get('_raw'):
+                ds.append(model.to_d(**kwargs))
+                continue
+            d = dict()
+            for name,val in sd.iteritems():
+                if val is None or name in skip or name in props:
+                    continue
+                try:
+                    d[name]=val.to_d()
+                except AttributeError:
+                    d[name]=val
+            ds.append(d)
+            batch.append((d,sd))
+        if not batch:
+            return ds
+        long_names = kwargs.get('long_names')
+        for name in props:
+            if name in skip:
+                continue
+            column = [(d,sd.get(name)) for d,sd in batch]
+            column = [(d,val) for d,val in column if val is not None]
+            if not column:
+                continue
+            prop = getattr(cls,name)
+            key = name if long_names else prop.name
+            vals = prop.to_d_column([val for d,val in column], **kwargs)
+            for (d,old),val in zip(column,vals):
+                d[key] = val
+        return ds
+
+    def _load_lazy(self, prop):
+        "decode a field that from_db(lazy=True) left in self._raw"
+        name = self.long_names[prop.name]
+        raw = self.__dict__.get('_raw')
+        if not raw or name not in raw:
+            raise AttributeError(name)
+        val = raw.pop(name)
+        if val is not None:
+            val = prop.from_db(val)
+        self.__dict__[name] = val
+        return val
+
+    @classmethod
+    def from_db(cls, d, lazy=False, fields=None, **kwargs):
+        """Build an object from a document that came out of the database.
+        The values were validated when they were saved, so they are assigned
+        directly instead of going through Property.validated.
+
+        If lazy is set, the fields are kept as they are in d and decoded the
+        first time they are read.  kwargs are the arguments to to_d that
+        built d; to_d calls with the same arguments reuse the raw values.
+
+        fields is the set of long names that d was projected to.  The other
+        fields are left out instead of getting defaults, and the object
+        refuses to save()."""
+        obj = object.__new__(_plain.get(cls, cls))
+        sd = obj.__dict__
+        loaders = cls._loaders
+        defaults = cls._defaults
+        if fields is not None:
+            sd['_partial'] = fields
+            defaults = [(n,f) for n,f in defaults if n in fields]
+        if lazy:
+            raw = sd['_raw'] = _RawDoc(kwargs)
+            for k,v in d.iteritems():
+                try:
+                    raw[loaders[k][0]] = v
+                except KeyError:
+                    sd[k] = v
+            for name,default in defaults:
+                if name not in raw and name not in sd:
+                    sd[name] = default()
+            return obj
+        for k,v in d.iteritems():
+            try:
+                name, load = loaders[k]
+            except KeyError:
+                sd[k] = v
+                continue
+            sd[name] = v if v is None else load(v)
+        for name,default in defaults:
+            if name not in sd:
+                sd[name] = default()
+        return obj
+
     def update(self,d):
         """convert key names in d to long names, and then use d to update
         self.__dict__"""
+        plan = self._plan
+        sd = self.__dict__
+        dirty = sd.get('_dirty',())
         for k,v in d.iteritems():
-            setattr(self,self.long_names.get(k,k),v)
+            try:
+                name, validated = plan[k]
+            except KeyError:
+                setattr(self,k,v)
+                continue
+            sd[name] = v if v is None else validated(v)
+            if dirty is not None:
+                if not dirty:
+                    dirty = sd['_dirty'] = set()
+                dirty.add(name)
+
+    def changed(self):
+        """Returns the long names of the fields that changed since the object
+        was loaded or saved, including changes inside of ModelProperty and
+        ListProperty values.  Returns None for objects that did not come from
+        the database, since everything about them is new."""
+        sd = self.__dict__
+        dirty = sd.get('_dirty',())
+        if dirty is None:
+            return None
+        found = set(dirty)
+        for name in self.long_names.itervalues():
+            if name not in found and _mutated(sd.get(name)):
+                found.add(name)
+        return found
+
+    def mark_clean(self):
+        "start tracking changes from the current state"
+        sd = self.__dict__
+        sd.pop('_dirty',None)
+        for name in self.long_names.itervalues():
+            _mark_clean(sd.get(name))
+
+    def _changes(self, **kwargs):
+        """Returns a dict of the changed fields to set and a list of the
+        changed fields to unset, both using short names."""
+        sets, unsets = {}, []
+        model = type(self)
+        sd = self.__dict__
+        for name in self.changed() or ():
+            prop = getattr(model,name,None)
+            val = sd.get(name)
+            if not isinstance(prop, Property):
+                if val is None:
+                    unsets.append(name)
+                else:
+                    sets[name] = getattr(val,'to_d',lambda: val)()
+            elif val is None:
+                unsets.append(prop.name)
+            else:
+                sets[prop.name] = prop.to_d(val, **kwargs)
+        return sets, unsets
+
+
+def _mutated(val):
+    "was a ModelPart or ListPropertyInstance changed in place?"
+    if isinstance(val, ModelPart):
+        return bool(val.changed())
+    if isinstance(val, ListPropertyInstance):
+        return val.dirty or any(_mutated(x) for x in val)
+    return False
+
+
+def _mark_clean(val):
+    if isinstance(val, ModelPart):
+        val.mark_clean()
+    elif isinstance(val, ListPropertyInstance):
+        val.dirty = False
+        for x in val:
+            _mark_clean(x)
 
 
 class ModelProperty(TypedProperty):
@@ -376,6 +1033,14 @@ class ModelProperty(TypedProperty):
     def to_d(self, val, **kwargs):
         return val.to_d(**kwargs)
 
+    def to_d_column(self, vals, **kwargs):
+        return self.kind.to_dicts(vals, **kwargs)
+
+    def from_db(self, val):
+        if isinstance(val, self.kind):
+            return val
+        return self.kind.from_db(val)
+
     def validated(self, val):
         val = Property.validated(self, val)
         if not isinstance(val, self.kind):
@@ -390,31 +1055,74 @@ class ModelListProperty(ListProperty):
     def to_d(self, val, **kwargs):
         return [x.to_d(**kwargs) for x in val]
 
+    def to_d_column(self, vals, **kwargs):
+        #convert the items of every list together, and then split them up
+        ds = iter(self._kind.to_dicts(
+            [x for val in vals for x in val], **kwargs))
+        return [list(islice(ds, len(val))) for val in vals]
+
     def validated_item(self, val):
         if not isinstance(val, self._kind):
             return self._kind(val)
         return val
 
+    def from_db(self, val):
+        kind = self._kind
+        ret = ListPropertyInstance(self)
+        list.extend(ret,
+            (v if isinstance(v, kind) else kind.from_db(v) for v in val))
+        return ret
+
 
 class Model(ModelPart):
+    __slots__ = ()
     _id = IdProperty("_id")
     _rev = IdProperty('_rev')
 
     def save(self):
         "Save the model to the database, may overwrite existing objects"
-        return self.database.save(self)
+        if self.__dict__.get('_partial') is not None:
+            raise PartialModelError(
+                "%s was loaded with fields=, use merge() to save it"%
+                self.__class__.__name__)
+        ret = self.database.save(self)
+        if not getattr(self.database, 'queues_writes', False):
+            self.mark_clean()
+        return ret
 
     def delete(self):
         "remove the object from the database"
         return self.database.delete_id(self.__class__.__name__,self._id)
 
     def merge(self):
-        "Use this object to update an object that is already in the database."
+        """Use this object to update an object that is already in the database.
+        For models loaded with fields=, only the loaded fields are sent."""
         return self.database.merge(self)
 
+    def update_changed(self):
+        """Send only the fields that changed since this object was loaded or
+        saved.  Objects that are not tracked are merged."""
+        ret = self.database.update_changed(self)
+        self.mark_clean()
+        return ret
+
+    def asave(self):
+        """save() on one of the threads of an AsyncDB, returns an
+        AsyncResult.  The a* methods only work with AsyncDB."""
+        return self.database.run(self.save)
+
+    def amerge(self):
+        return self.database.run(self.merge)
+
+    @classmethod
+    def bulk_save(cls, models, **kwargs):
+        """save an iterable of models.  mongo and couch accept chunk_size,
+        ordered and workers to control how they are sent."""
+        return cls.database.bulk_save_models(models, cls, **kwargs)
+
     @classmethod
-    def bulk_save(cls, models):
-        return cls.database.bulk_save_models(models, cls)
+    def abulk_save(cls, models, **kwargs):
+        return cls.database.run(cls.bulk_save, models, **kwargs)
 
     @classmethod
     def in_db(cls,_id):
@@ -424,14 +1132,39 @@ class Model(ModelPart):
     def __contains__(cls,_id):
         return cls.in_db(_id)
 
+    @classmethod
+    def ain_db(cls, _id):
+        return cls.database.run(cls.in_db, _id)
+
     @classmethod
     def get_id(cls, _id, **kwargs):
         return cls.database.get_id(cls,_id, **kwargs)
 
+    @classmethod
+    def aget_id(cls, _id, **kwargs):
+        return cls.database.run(cls.get_id, _id, **kwargs)
+
+    @classmethod
+    def get_ids(cls, ids, **kwargs):
+        "yields the objects whose ids are in ids, skipping missing ones"
+        return cls.database.get_ids(cls, ids, **kwargs)
+
     @classmethod
     def get_all(cls,**kwargs):
         return cls.database.get_all(cls,**kwargs)
 
+    @classmethod
+    def update_where(cls, q, *updates, **kwargs):
+        """Atomically apply updates like FunModel.real.inc(2) to the objects
+        that match q, and return how many changed.  Set multi=False to only
+        change the first one."""
+        if q is False or q is True:
+            raise BogusQuery("The first term in a comparison must be a Property.")
+        update = reduce(U.__and__, updates, U())
+        if not update:
+            return 0
+        return cls.database.update_where(cls, q, update, **kwargs)
+
     @classmethod
     def coll(cls):
         "Get the collection - only works for mongo-esque databases"
@@ -445,33 +1178,543 @@ class Model(ModelPart):
             raise BogusQuery("The first term in a comparison must be a Property.")
         return cls.database.find(cls, q, **kwargs)
 
+    @classmethod
+    def afind(cls, q=None, **kwargs):
+        "find() on a background thread of an AsyncDB, returns an iterator"
+        if q is False or q is True:
+            raise BogusQuery("The first term in a comparison must be a Property.")
+        return cls.database.afind(cls, q, **kwargs)
+
+    @classmethod
+    def parallel_scan(cls, q=None, workers=4, **kwargs):
+        """Yields the objects that match q in no particular order.  mongo and
+        couch split the collection into ranges and read workers ranges at
+        once.  Couch only supports q=None."""
+        if q is False or q is True:
+            raise BogusQuery("The first term in a comparison must be a Property.")
+        return cls.database.parallel_scan(cls, q, workers, **kwargs)
+
+    @classmethod
+    def find_columns(cls, q=None, fields=None, **kwargs):
+        """Like find, but returns a dict of columns keyed by long name instead
+        of models.  Dates, bools, ints and floats are array.arrays, or numpy
+        arrays if numpy=True is set, with dates as seconds since 1970."""
+        if q is False or q is True:
+            raise BogusQuery("The first term in a comparison must be a Property.")
+        return cls.database.find_columns(cls, q, fields, **kwargs)
+
+    @classmethod
+    def map_results(cls, q, func, processes=None, chunk=100, reducer=None,
+            **kwargs):
+        """Call func on every object that matches q in a pool of processes.
+        func must be picklable, and gets objects rebuilt from their documents
+        in the worker.  Yields the results, in order unless ordered=False is
+        set.  If reducer is set, returns reduce(reducer, results) instead."""
+        if q is False or q is True:
+            raise BogusQuery("The first term in a comparison must be a Property.")
+        results = cls.database.map_results(
+                cls, q, func, processes, chunk, **kwargs)
+        if reducer is None:
+            return results
+        return reduce(reducer, results)
+
     @classmethod
     def paged_view(cls,view_name,**kwargs):
         "look at a view through an iterator - only works with couchdb"
         return cls.database.paged_view(view_name,cls=cls,**kwargs)
 
 
+class _Part(ModelPart):
+    "what ModelPart() makes, since ModelPart has no __dict__"
+
+
+class _Model(Model):
+    "what Model() makes, since Model has no __dict__"
+
+
+_plain = {ModelPart:_Part, Model:_Model}
+
+
+class RandomPolicy(object):
+    """Eviction policies decide which keys a ModelCache drops when it is
+    full.  This one drops half of the cache, picked arbitrarily."""
+    def __init__(self):
+        self.keys = set()
+
+    def record(self, key):
+        "called every time key is looked up"
+        pass
+
+    def insert(self, key):
+        self.keys.add(key)
+
+    def remove(self, key):
+        self.keys.discard(key)
+
+    def victims(self):
+        "returns the keys to drop to make room"
+        return list(islice(self.keys, max(1,len(self.keys)/2)))
+
+    def admit(self, key, victims):
+        "returns False if key is not worth dropping victims"
+        return True
+
+
+class LRUPolicy(RandomPolicy):
+    "drops the least recently used key"
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    def record(self, key):
+        if key in self.keys:
+            del self.keys[key]
+            self.keys[key] = None
+
+    def insert(self, key):
+        self.keys[key] = None
+
+    def remove(self, key):
+        self.keys.pop(key,None)
+
+    def victims(self):
+        return [next(iter(self.keys))]
+
+
+class TinyLFUPolicy(LRUPolicy):
+    """Drops the least recently used key, but only to make room for a key
+    that has been looked up more often.  Lookups are counted approximately
+    in a count-min sketch that is halved every sample lookups, so old
+    popularity fades away."""
+    def __init__(self, width=4096, depth=4, sample=40960):
+        LRUPolicy.__init__(self)
+        self.width = width
+        self.sample = sample
+        self.counts = [[0]*width for x in xrange(depth)]
+        self.seeds = range(depth)
+        self.lookups = 0
+
+    def _slots(self, key):
+        return ( hash((seed,key))%self.width for seed in self.seeds )
+
+    def frequency(self, key):
+        return min(row[i] for row,i in zip(self.counts, self._slots(key)))
+
+    def record(self, key):
+        LRUPolicy.record(self, key)
+        for row,i in zip(self.counts, self._slots(key)):
+            row[i] += 1
+        self.lookups += 1
+        if self.lookups>=self.sample:
+            self.lookups = 0
+            for row in self.counts:
+                row[:] = [x/2 for x in row]
+
+    def admit(self, key, victims):
+        freq = self.frequency(key)
+        return all(freq>self.frequency(v) for v in victims)
+
+
+def _estimate_size(obj):
+    "a rough guess at the number of bytes that a model uses"
+    size = sys.getsizeof(obj)
+    try:
+        d = obj.__dict__
+    except AttributeError:
+        return size
+    return size+sys.getsizeof(d)+sum(sys.getsizeof(v) for v in d.itervalues())
+
+
 class ModelCache(dict):
-    def __init__(self, Class, limit=10000, **kwargs):
+    def __init__(self, Class, limit=10000, policy=None, max_bytes=None,
+            sizeof=_estimate_size, ttl=None, negative_ttl=None,
+            refresh_ahead=None, clock=time.time, chunk_size=1000, workers=1,
+            **kwargs):
+        """Class.get_id(key,**kwargs) is called to fill in missing keys.  At
+        most limit objects are kept, and if max_bytes is set, the sizes of
+        the objects, as measured by sizeof, stay under max_bytes.  policy
+        picks what to drop when the cache is full, the default is to drop
+        half of the cache.
+
+        Entries expire ttl seconds after they are loaded.  Keys that are not
+        in the database are cached as None for negative_ttl seconds, which
+        defaults to ttl; set it to 0 to not cache them.  If refresh_ahead is
+        a fraction like 0.8, entries that are looked up after that much of
+        their ttl has passed are reloaded by the next refresh() or
+        ensure_ids() call, so that busy keys never expire.
+
+        ensure_ids() loads chunk_size ids per query and runs up to workers
+        queries at once."""
         dict.__init__(self)
         self.Class = Class
         self.limit = limit
         self.kwargs = kwargs
+        self.policy = RandomPolicy() if policy is None else policy
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.sizes = {}
+        self.bytes = 0
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.clock = clock
+        self.chunk_size = chunk_size
+        self.workers = workers
+        #key -> (time loaded, time it expires)
+        self.expires = {}
+        self.stale = set()
+        self.hits = self.misses = self.evictions = self.rejections = 0
+        self.expirations = self.refreshes = 0
+
+    def __getitem__(self, key):
+        self.policy.record(key)
+        if dict.__contains__(self, key):
+            if self._fresh(key):
+                self.hits += 1
+                return dict.__getitem__(self, key)
+            self._drop(key)
+            self.expirations += 1
+        return self.__missing__(key)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            return False
+        if self._fresh(key):
+            return True
+        self._drop(key)
+        self.expirations += 1
+        return False
 
     def __missing__(self, key):
-        if len(self)>=self.limit:
-            #random cache replacement policy
-            for x in xrange(len(self)/2):
-                self.popitem()
+        self.misses += 1
         obj = self.Class.get_id(key, **self.kwargs)
-        self[key] = obj
+        self.set(key, obj)
         return obj
 
+    def __setitem__(self, key, obj):
+        self.set(key, obj)
+
+    def set(self, key, obj, ttl=None):
+        "like self[key]=obj, but ttl overrides the ttl of the cache"
+        if ttl is None:
+            ttl = self.ttl if obj is not None else self.negative_ttl
+        if dict.__contains__(self, key):
+            self._drop(key)
+        if ttl==0:
+            return
+        size = self.sizeof(obj) if self.max_bytes is not None else 0
+        while self and self._full(size):
+            victims = self.policy.victims()
+            if not self.policy.admit(key, victims):
+                self.rejections += 1
+                return
+            for victim in victims:
+                self._drop(victim)
+                self.evictions += 1
+        dict.__setitem__(self, key, obj)
+        self.policy.insert(key)
+        if size:
+            self.sizes[key] = size
+            self.bytes += size
+        if ttl is not None:
+            now = self.clock()
+            self.expires[key] = (now, now+ttl)
+
+    def __delitem__(self, key):
+        dict.__getitem__(self, key)
+        self._drop(key)
+
+    #the dict methods that change it would skip the policy, sizes and expiry
+    def pop(self, key, *default):
+        if not dict.__contains__(self, key):
+            if default:
+                return default[0]
+            raise KeyError(key)
+        obj = dict.__getitem__(self, key)
+        self._drop(key)
+        return obj
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): cache is empty')
+        key = next(dict.__iter__(self))
+        return key, self.pop(key)
+
+    def clear(self):
+        for key in dict.keys(self):
+            self._drop(key)
+
+    def update(self, *args, **kwargs):
+        for key, obj in dict(*args, **kwargs).iteritems():
+            self.set(key, obj)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.set(key, default)
+        return dict.get(self, key, default)
+
+    #the dict methods that read it would return expired entries
+    def get(self, key, default=None):
+        "returns the cached object for key or default, without loading it"
+        if key in self:
+            return dict.__getitem__(self, key)
+        return default
+
+    def _expire(self):
+        "drop every entry that has expired"
+        if not self.expires:
+            return
+        now = self.clock()
+        for key in [k for k,(loaded,expires) in self.expires.iteritems()
+                if now>=expires]:
+            self._drop(key)
+            self.expirations += 1
+
+    def keys(self):
+        self._expire()
+        return dict.keys(self)
+
+    def values(self):
+        self._expire()
+        return dict.values(self)
+
+    def items(self):
+        self._expire()
+        return dict.items(self)
+
+    def __iter__(self):
+        self._expire()
+        return dict.__iter__(self)
+
+    def iterkeys(self):
+        return self.__iter__()
+
+    def itervalues(self):
+        self._expire()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._expire()
+        return dict.iteritems(self)
+
+    def _fresh(self, key):
+        "returns False if key has expired, and notes keys to refresh"
+        times = self.expires.get(key)
+        if times is None:
+            return True
+        loaded, expires = times
+        now = self.clock()
+        if now>=expires:
+            return False
+        if self.refresh_ahead is not None:
+            if now>=loaded+self.refresh_ahead*(expires-loaded):
+                self.stale.add(key)
+        return True
+
+    def _full(self, size):
+        if len(self)>=self.limit:
+            return True
+        return self.max_bytes is not None and self.bytes+size>self.max_bytes
+
+    def _drop(self, key):
+        dict.__delitem__(self, key)
+        self.policy.remove(key)
+        self.bytes -= self.sizes.pop(key,0)
+        self.expires.pop(key,None)
+        self.stale.discard(key)
+
+    def stats(self):
+        "returns counters that can be exported to a monitoring system"
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            rejections=self.rejections,
+            expirations=self.expirations,
+            refreshes=self.refreshes,
+            size=len(self),
+            bytes=self.bytes,
+            )
+
+    def refresh(self):
+        "reload the entries that refresh_ahead picked with one query"
+        self.ensure_ids(())
+
     def ensure_ids(self, ids):
         """make sure that all of the objects with an id in ids are in the cache.
-        This exists to reduce the number of database calls made."""
-        #FIXME: make a couch version
+        This exists to reduce the number of database calls made.  Entries
+        that are due to be refreshed are reloaded along with them.  Returns
+        a summary of what was cached, loaded and missing, and how many
+        queries were made."""
+        ids = list(OrderedDict.fromkeys(ids))
+        requested = len(ids)
         ids = [id for id in ids if id not in self]
-        if ids:
-            for obj in self.Class.find(Model._id.is_in(ids)):
+        hits = requested-len(ids)
+        ids.extend(self._take_stale())
+        size = self.chunk_size
+        chunks = [ids[i:i+size] for i in xrange(0,len(ids),size)]
+        loaded = 0
+        missing = set(ids)
+        for objs in self._fetch_chunks(chunks):
+            for obj in objs:
                 self[obj._id] = obj
+                missing.discard(obj._id)
+                loaded += 1
+        for id in missing:
+            self[id] = None
+        return dict(
+            requested=requested,
+            hits=hits,
+            loaded=loaded,
+            missing=len(missing),
+            queries=len(chunks),
+            saved=len(ids)-len(chunks),
+            )
+
+    def _take_stale(self):
+        "returns the keys that need to be refreshed"
+        stale = [id for id in self.stale if dict.__contains__(self,id)]
+        self.stale.clear()
+        self.refreshes += len(stale)
+        return stale
+
+    def _fetch_chunks(self, chunks):
+        "yields lists of the objects in each chunk of ids"
+        fetch = lambda chunk: list(self.Class.get_ids(chunk, **self.kwargs))
+        if self.workers<=1 or len(chunks)<=1:
+            for chunk in chunks:
+                yield fetch(chunk)
+            return
+        pool = ThreadPool(min(self.workers,len(chunks)))
+        try:
+            for objs in pool.imap_unordered(fetch, chunks):
+                yield objs
+        finally:
+            pool.close()
+
+
+class _Flight(object):
+    "a key that one thread is loading and other threads are waiting for"
+    def __init__(self):
+        self.done = threading.Event()
+        self.obj = None
+        self.error = None
+
+
+class ThreadSafeModelCache(ModelCache):
+    def __init__(self, Class, batch_window=0.002, **kwargs):
+        """A ModelCache that can be shared by threads.  When several threads
+        miss on the same key, only one of them calls the database and the
+        others wait for it.  A miss while other keys are being loaded waits
+        batch_window seconds for more misses, and then loads them all with
+        one get_ids query; a miss when nothing else is loading is loaded
+        right away.  The other arguments are the same as for ModelCache."""
+        ModelCache.__init__(self, Class, **kwargs)
+        self.lock = threading.RLock()
+        self.batch_window = batch_window
+        self.flights = {}
+        self.batch = None
+        self.coalesced = 0
+
+    def __getitem__(self, key):
+        with self.lock:
+            self.policy.record(key)
+            if dict.__contains__(self, key):
+                if self._fresh(key):
+                    self.hits += 1
+                    return dict.__getitem__(self, key)
+                self._drop(key)
+                self.expirations += 1
+            flight = self.flights.get(key)
+            leader = wait = False
+            if flight is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                flight = self.flights[key] = _Flight()
+                if self.batch is None:
+                    self.batch = [key]
+                    leader = True
+                    #only wait for company if other keys are loading
+                    wait = len(self.flights)>1
+                else:
+                    self.batch.append(key)
+        if leader:
+            self._load_batch(wait)
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.obj
+
+    def _load_batch(self, wait):
+        "wait for other misses if asked to, and then load them all at once"
+        if wait:
+            time.sleep(self.batch_window)
+        with self.lock:
+            keys, self.batch = self.batch, None
+        found, error = {}, None
+        try:
+            if len(keys)==1:
+                found[keys[0]] = self.Class.get_id(keys[0], **self.kwargs)
+            else:
+                for obj in self.Class.get_ids(keys, **self.kwargs):
+                    found[obj._id] = obj
+        except Exception, e:
+            error = e
+        with self.lock:
+            for key in keys:
+                flight = self.flights.pop(key)
+                if error is None:
+                    flight.obj = found.get(key)
+                    self.set(key, flight.obj)
+                flight.error = error
+                flight.done.set()
+
+    def __contains__(self, key):
+        with self.lock:
+            return ModelCache.__contains__(self, key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            ModelCache.__delitem__(self, key)
+
+    def pop(self, *args, **kwargs):
+        with self.lock:
+            return ModelCache.pop(self, *args, **kwargs)
+
+    def popitem(self, *args, **kwargs):
+        with self.lock:
+            return ModelCache.popitem(self, *args, **kwargs)
+
+    def clear(self, *args, **kwargs):
+        with self.lock:
+            return ModelCache.clear(self, *args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        with self.lock:
+            return ModelCache.update(self, *args, **kwargs)
+
+    def setdefault(self, *args, **kwargs):
+        with self.lock:
+            return ModelCache.setdefault(self, *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        with self.lock:
+            return ModelCache.get(self, *args, **kwargs)
+
+    def set(self, key, obj, ttl=None):
+        with self.lock:
+            ModelCache.set(self, key, obj, ttl)
+
+    def stats(self):
+        with self.lock:
+            stats = ModelCache.stats(self)
+            stats['coalesced'] = self.coalesced
+            return stats
+
+    def _take_stale(self):
+        with self.lock:
+            return ModelCache._take_stale(self)
+
+    def _expire(self):
+        with self.lock:
+            ModelCache._expire(self)
@@ -1,10 +1,48 @@
 
+from array import array
+import calendar
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+import sys
+import threading
+
+from maroon import BoolProperty, DateTimeProperty, FloatProperty, IntProperty
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 try:
     from mongo import ASCENDING, DESCENDING
 except ImportError:
     ASCENDING, DESCENDING = 1,-1
 
 class MaroonDB(object):
+    #documents from the database were validated when they were saved, so we
+    #skip validation when loading them unless verify is set
+    verify = False
+    #the arguments to to_d that this database stores documents with
+    doc_format = {}
+    #databases that hold on to writes and send them later mark the models
+    #clean themselves
+    queues_writes = False
+
+    def _load(self, cls, d, lazy=False, fields=None):
+        """turn a document from the database into a model.  fields is the
+        set of long names the document was projected to."""
+        if lazy or fields is not None:
+            return cls.from_db(d, lazy, fields, **self.doc_format)
+        return cls(d) if self.verify else cls.from_db(d)
+
+    def healthy(self):
+        "can the database answer requests?  PooledDB checks idle databases"
+        return True
+
     def merge(self, model):
         old = self.get_id(model.__class__,model._id)
         d = model.to_d(dateformat="datetime")
@@ -12,9 +50,80 @@ class MaroonDB(object):
         old.update(d)
         old.save()
 
+    def update_changed(self, model):
+        if model.changed() is None:
+            return self.merge(model)
+        sets, unsets = model._changes(dateformat="datetime")
+        if not sets and not unsets:
+            return
+        old = self.get_id(model.__class__,model._id)
+        old.update(sets)
+        old.update(dict.fromkeys(unsets))
+        old.save()
+
+    def update_where(self, cls, q, update, multi=True):
+        """emulate an atomic update by loading the objects that match q,
+        changing them, and saving them back"""
+        found = list(self.find(cls, q, limit=None if multi else 1))
+        for obj in found:
+            update.apply(obj)
+            self.save(obj)
+        return len(found)
+
+    def find_docs(self, cls, q=None, **kwargs):
+        "yields the stored form of the objects that match q"
+        return (m.to_d(**self.doc_format) for m in self.find(cls, q, **kwargs))
+
+    def find_columns(self, cls, q=None, fields=None, numpy=False, **kwargs):
+        docs = self.find_docs(cls, q, fields=fields, **kwargs)
+        return _columns(cls, docs, fields, numpy)
+
+    def map_results(self, cls, q, func, processes=None, chunk=100,
+            ordered=True, fields=None, **kwargs):
+        """yields func(obj) for the objects that match q.  The documents are
+        sent to a pool of processes chunk at a time and turned into objects
+        there.  If ordered is False, results come back as they finish."""
+        loaded = _projection(cls, fields)[1]
+        docs = self.find_docs(cls, q, fields=fields, **kwargs)
+        pool = Pool(processes)
+        #keep every process busy without reading all the docs at once
+        depth = 2*(processes or cpu_count())
+        pending = deque()
+
+        def next_chunk():
+            if ordered:
+                return pending.popleft().get()
+            while True:
+                for job in pending:
+                    if job.ready():
+                        pending.remove(job)
+                        return job.get()
+                pending[0].wait(0.01)
+
+        try:
+            for part in _chunks(docs, chunk):
+                if len(pending)>=depth:
+                    for res in next_chunk():
+                        yield res
+                pending.append(pool.apply_async(
+                    _map_chunk, (cls, func, part, loaded)))
+            while pending:
+                for res in next_chunk():
+                    yield res
+        finally:
+            pool.terminate()
+
+    def parallel_scan(self, cls, q=None, workers=4, **kwargs):
+        """yields the objects that match q.  Databases that can split a scan
+        into ranges read them on workers threads, the rest read serially."""
+        return iter(self.find(cls, q, **kwargs))
+
     def get_all(self, cls, **kwargs):
         return self.find(cls,None,**kwargs)
 
+    def get_ids(self, cls, ids, **kwargs):
+        return self.find(cls,{'_id':{'$in':list(ids)}},**kwargs)
+
     def _sort_key_list(self, sort=None, sort_list=None, desc=False, **kwargs):
         if sort_list and sort:
             raise ValueError("Do not set sort_list and sort parameters.")
@@ -26,6 +135,212 @@ class MaroonDB(object):
             return []
 
 
+def _chunks(items, size):
+    "split an iterable into lists of size items without reading it all"
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _pipeline(func, chunks, workers=1):
+    """yields func(chunk) for each chunk.  If workers>1, up to workers calls
+    run at once on a thread pool, and only that many chunks are held in
+    memory.  Results come back in the order of chunks."""
+    if workers<=1:
+        for chunk in chunks:
+            yield func(chunk)
+        return
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for chunk in chunks:
+            if len(pending)>=workers:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(func, (chunk,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.close()
+
+
+def _map_chunk(cls, func, docs, fields):
+    "runs in a worker process for MaroonDB.map_results"
+    return [func(cls.from_db(d, fields=fields)) for d in docs]
+
+
+def _put(queue, entry, stop):
+    "put entry in queue, but give up if stop is set instead of blocking"
+    while not stop.is_set():
+        try:
+            queue.put(entry, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _prefetch(items, depth=1):
+    """yields the items of an iterator while a background thread reads up to
+    depth items ahead of the consumer.  depth=0 reads them in this thread."""
+    if depth<1:
+        for item in items:
+            yield item
+        return
+    queue = Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                if not _put(queue, (item, None), stop):
+                    return
+        except Exception:
+            _put(queue, (done, sys.exc_info()), stop)
+        else:
+            _put(queue, (done, None), stop)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is done:
+                if error:
+                    raise error[0], error[1], error[2]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def _interleave(scans, workers=1, depth=1000):
+    """Calls each function in scans on one of workers threads and yields the
+    items of the iterators they return in the order they arrive.  At most
+    depth items wait for the consumer."""
+    tasks = Queue()
+    for scan in scans:
+        tasks.put(scan)
+    queue = Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def work():
+        try:
+            while not stop.is_set():
+                try:
+                    scan = tasks.get_nowait()
+                except Empty:
+                    break
+                for item in scan():
+                    if not _put(queue, (item, None), stop):
+                        return
+        except Exception:
+            _put(queue, (done, sys.exc_info()), stop)
+        else:
+            _put(queue, (done, None), stop)
+
+    threads = [threading.Thread(target=work) for x in xrange(max(workers,1))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            item, error = queue.get()
+            if item is done:
+                if error:
+                    raise error[0], error[1], error[2]
+                running -= 1
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+def _ranges(bounds):
+    "turn sorted split points into (start, end) pairs, None is unbounded"
+    bounds = [None]+list(bounds)+[None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _projection(cls, fields):
+    """turn a list of Properties or names into the short names to ask the
+    database for and the set of long names that will be loaded"""
+    if fields is None:
+        return None, None
+    names = set(_field_name(f) for f in fields)
+    names.add('_id')
+    return list(names), frozenset(cls.long_names.get(n,n) for n in names)
+
+
+def _project(d, names):
+    "emulate a projection for databases that always return the whole doc"
+    return dict((k,d[k]) for k in names if k in d)
+
+
+def _epoch(val):
+    "seconds since 1970 for a date in any of the formats to_d makes"
+    if isinstance(val, datetime):
+        return calendar.timegm(val.timetuple())
+    if isinstance(val, (list,tuple)):
+        return calendar.timegm(tuple(val[:6])+(0,0,0))
+    return int(val)
+
+
+#typecode, converter and value for missing fields of the typed columns
+_column_types = [
+    (DateTimeProperty, 'l', _epoch, 0),
+    (BoolProperty, 'b', bool, 0),
+    (IntProperty, 'l', int, 0),
+    (FloatProperty, 'd', float, float('nan')),
+    ]
+
+
+def _columns(cls, docs, fields=None, use_numpy=False):
+    """Read docs, which are documents from the database, into a dict of
+    columns keyed by long name.  fields are Properties or short names.
+    Dates, bools, ints and floats go into array.array (or numpy arrays if
+    use_numpy is set) with dates as seconds since 1970 and missing values as
+    0 or nan.  Other fields are lists."""
+    if fields is None:
+        fields = cls.long_names.keys()
+    specs = []
+    for field in fields:
+        short = _field_name(field)
+        prop = getattr(cls, cls.long_names[short])
+        for kind,code,convert,missing in _column_types:
+            if isinstance(prop, kind):
+                specs.append((short, array(code), convert, missing))
+                break
+        else:
+            specs.append((short, [], None, None))
+    for d in docs:
+        for short,col,convert,missing in specs:
+            val = d.get(short)
+            if convert is None:
+                col.append(val)
+            else:
+                col.append(missing if val is None else convert(val))
+    columns = dict(
+        (cls.long_names[short], col) for short,col,convert,missing in specs)
+    if use_numpy:
+        if numpy is None:
+            raise ImportError("find_columns(numpy=True) needs numpy")
+        for name,col in columns.iteritems():
+            if isinstance(col, array):
+                dtype = numpy.bool_ if col.typecode=='b' else col.typecode
+                columns[name] = numpy.frombuffer(col, dtype) if col else \
+                        numpy.zeros(0, dtype)
+            else:
+                columns[name] = numpy.array(col, dtype=object)
+    return columns
+
+
 def _sort_key_item(item,desc):
     if isinstance(item,(list,tuple)):
         return (_field_name(item[0]), item[1])
@@ -3,16 +3,28 @@ try:
 except:
     import json
 from collections import defaultdict
-from operator import attrgetter
+from itertools import count, chain, islice
+from bisect import bisect_left, bisect_right
 import operator
+from operator import itemgetter
+import heapq
 import glob
-from maroondb import MaroonDB, ASCENDING, DESCENDING
+from maroondb import MaroonDB, ASCENDING, DESCENDING, _field_name
+from maroondb import _projection, _project
+
+#how many compiled predicates MockDB keeps before it starts over
+_PREDICATE_LIMIT = 1000
 
 class MockDB(MaroonDB):
     """Read a tiny database from the filesystem, and modify it in-memory.
     This class is only for testing and debuging purposes!"""
-    def __init__(self, path=None, module=None):
+    def __init__(self, path=None, module=None, verify=False):
         self.data = defaultdict(dict)
+        self.verify = verify
+        #compiled query predicates, keyed by model and query shape
+        self._predicates = {}
+        #secondary indexes, keyed by model name and then short name
+        self.indexes = defaultdict(dict)
         if path and module:
             for filepath in glob.glob(path+"/*.json"):
                 self._import_json(filepath,module)
@@ -21,48 +33,148 @@ class MockDB(MaroonDB):
         name = path.rpartition('/')[2].replace(".json","")
         cls = getattr(module,name)
         for line in open(path):
-            self.save(cls(from_dict=json.loads(line)))
+            self.save(self._load(cls,json.loads(line)))
 
-    def bulk_save_models(self, models, cls=None):
+    def bulk_save_models(self, models, cls=None, **kwargs):
         for m in models:
             self.save(m)
 
     def save(self, model):
         if model._id is None:
             model._id = id(model)
-        self.data[model.__class__.__name__][model._id] = model
+        name = model.__class__.__name__
+        self.data[name][model._id] = model
+        for index in self.indexes[name].itervalues():
+            index.remove(model._id)
+            index.add(model._id, getattr(model,index.attr))
         return model
 
-    def get_id(self, cls, _id, **kwargs):
-        return self.data[cls.__name__].get(_id,None)
+    def delete_id(self, name, _id):
+        self.data[name].pop(_id,None)
+        for index in self.indexes[name].itervalues():
+            index.remove(_id)
+
+    def ensure_index(self, cls, field, ordered=False):
+        """Index field for find().  Hash indexes answer equality and $in
+        queries, ordered indexes also answer ranges and sorts."""
+        key = _field_name(field)
+        old = self.indexes[cls.__name__].get(key)
+        #an ordered index can do everything a hash index can
+        if old is not None and (isinstance(old,_SortedIndex) or not ordered):
+            return
+        attr = cls.long_names.get(key,key)
+        index = _SortedIndex(attr) if ordered else _HashIndex(attr)
+        index.build(
+            (_id, getattr(obj,attr))
+            for _id,obj in self.data[cls.__name__].iteritems()
+        )
+        self.indexes[cls.__name__][key] = index
+
+    def get_id(self, cls, _id, fields=None, **kwargs):
+        obj = self.data[cls.__name__].get(_id,None)
+        if obj is None or fields is None:
+            return obj
+        return self._partial(cls, obj, *_projection(cls, fields))
+
+    def _partial(self, cls, obj, names, fields):
+        "returns a copy of obj that only has fields"
+        d = _project(obj.to_d(dateformat="datetime"), names)
+        return cls.from_db(d, fields=fields)
+
+    def get_ids(self, cls, ids, **kwargs):
+        coll = self.data[cls.__name__]
+        return [coll[_id] for _id in ids if _id in coll]
 
-    def find(self, cls, q=None, limit=None, **kwargs):
-        long_names = cls.long_names
+    def find(self, cls, q=None, limit=None, skip=0, fields=None, **kwargs):
         if q:
             try:
                 q = q.to_mongo_dict()
             except AttributeError:
                 pass
-            results = [ obj
-                for obj in self.data[cls.__name__].itervalues()
-                if _query_matches(q, obj, long_names)
-                ]
+        cursor = MockCursor(self, cls, q, self._sort_key_list(**kwargs),
+                fields)
+        return cursor.skip(skip).limit(limit)
+
+    def _execute(self, cls, q, sort_args=(), limit=None, skip=0):
+        "yields the results of a query, only sorts if it has to"
+        coll = self.data[cls.__name__]
+        plan = test = None
+        if q:
+            test, params = self._predicate(cls, q)
+            plan = self._plan(cls, q)
+        end = None if limit is None else skip+limit
+        ids = None if plan is None else plan[1]
+        walk = self._index_walk(cls, sort_args)
+        if walk is not None and end is not None:
+            #walking the index in order costs about end*len(coll)/matches,
+            #filtering and then sorting costs about matches
+            guess = len(coll) if plan is None else plan[0]
+            if guess*guess > end*len(coll):
+                ids, sort_args = (lambda: walk), ()
+        if ids is None:
+            results = coll.itervalues()
         else:
-            results = self.data[cls.__name__].values()
-        sort_args = self._sort_key_list(**kwargs)
+            results = (coll[_id] for _id in ids())
+        if test is not None:
+            results = ( obj for obj in results if test(obj, params) )
         if sort_args:
-            sort_args.reverse()
-            for name,dir in sort_args:
-                results.sort(
-                    key=attrgetter(long_names.get(name)),
-                    reverse=(dir==DESCENDING))
-        if limit is not None:
-            results = results[0:limit]
-        return results
+            key, reverse = _sort_key(cls.long_names, sort_args)
+            if end is not None:
+                #only keep the best objects instead of sorting them all
+                pick = heapq.nlargest if reverse else heapq.nsmallest
+                results = pick(end, results, key=key)
+            else:
+                results = sorted(results, key=key, reverse=reverse)
+        return islice(results, skip, end)
 
     def in_coll(self, cls, _id):
         return _id in self.data[cls.__name__]
 
+    def _predicate(self, cls, q):
+        """returns a function test(obj,params) and the params that make it
+        match q.  The function only depends on the shape of q, so it is
+        compiled once and reused for queries that only differ by value."""
+        shape, params = _query_shape(q)
+        key = (cls, shape)
+        test = self._predicates.get(key)
+        if test is None:
+            if len(self._predicates) >= _PREDICATE_LIMIT:
+                self._predicates.clear()
+            test = _compile_shape(shape, cls.long_names, count())
+            self._predicates[key] = test
+        return test, params
+
+    def _plan(self, cls, q):
+        """Pick the most selective index for q.  Returns a guess at the
+        number of candidates and a function that returns their ids, or None
+        if every object has to be checked."""
+        indexes = self.indexes.get(cls.__name__)
+        if not indexes:
+            return None
+        best = None
+        for key,subq in q.iteritems():
+            if key=='$or':
+                plans = [self._plan(cls, sub) for sub in subq]
+                if None in plans:
+                    continue
+                plan = (sum(p[0] for p in plans), _union(plans))
+            else:
+                index = indexes.get(key)
+                plan = index and index.plan(subq)
+            if plan and (best is None or plan[0]<best[0]):
+                best = plan
+        return best
+
+    def _index_walk(self, cls, sort_args):
+        "returns the ids in sort order if an index can sort them"
+        if len(sort_args)!=1:
+            return None
+        name,dir = sort_args[0]
+        index = self.indexes.get(cls.__name__,{}).get(name)
+        if not isinstance(index,_SortedIndex) or index.loose:
+            return None
+        return index.walk(dir==DESCENDING)
+
 def _list_if_needed(v):
     return v if isinstance(v,list) else [v]
 
@@ -79,25 +191,404 @@ _mongo_ops = {
     }
 
 
-def _query_matches(query,obj,long_names):
-    for key,subq in query.iteritems():
+def _query_shape(query, params=None):
+    """Split a mongo-style query into a hashable shape and a list of the
+    values in it."""
+    if params is None:
+        params = []
+    shape = []
+    for key in sorted(query):
+        subq = query[key]
         if key=='$or':
-            if not any(_query_matches(q,obj,long_names) for q in subq):
-                return False
-            continue
-        val = getattr(obj,long_names.get(key,key))
-        if val==subq:
-            continue
+            shape.append((key, 'or',
+                tuple(_query_shape(q, params)[0] for q in subq)))
         elif isinstance(subq,dict):
-            for op,goal in subq.iteritems():
-                if not _mongo_ops[op](val,goal):
-                    return False
-        elif isinstance(val,list):
-            if subq not in val:
-                return False
+            ops = tuple(sorted(subq))
+            params.append(subq)
+            params.extend(subq[op] for op in ops)
+            shape.append((key, 'ops', ops))
         elif hasattr(subq,'search'):
-            if not subq.search(val):
-                return False
+            params.append(subq)
+            shape.append((key, 're', None))
         else:
+            params.append(subq)
+            shape.append((key, 'eq', None))
+    return tuple(shape), params
+
+
+def _compile_shape(shape, long_names, indexes):
+    """Build a function test(obj,params) from the output of _query_shape.
+    indexes yields the position of each value in params."""
+    tests = [
+        _compile_term(long_names.get(key,key), kind, info, long_names, indexes)
+        for key,kind,info in shape
+        ]
+    if len(tests)==1:
+        return tests[0]
+    def test(obj, params):
+        for t in tests:
+            if not t(obj, params):
+                return False
+        return True
+    return test
+
+
+def _compile_term(name, kind, info, long_names, indexes):
+    if kind=='or':
+        subs = [_compile_shape(sub, long_names, indexes) for sub in info]
+        def test(obj, params):
+            for sub in subs:
+                if sub(obj, params):
+                    return True
             return False
+        return test
+
+    i = next(indexes)
+    if kind=='ops':
+        ops = [(_mongo_ops[op], next(indexes)) for op in info]
+        def test(obj, params):
+            val = getattr(obj,name)
+            if val==params[i]:
+                return True
+            for op,j in ops:
+                if not op(val,params[j]):
+                    return False
+            return True
+    elif kind=='re':
+        def test(obj, params):
+            val = getattr(obj,name)
+            goal = params[i]
+            if val==goal:
+                return True
+            if isinstance(val,list):
+                return goal in val
+            return bool(goal.search(val))
+    else:
+        def test(obj, params):
+            val = getattr(obj,name)
+            goal = params[i]
+            return val==goal or (isinstance(val,list) and goal in val)
+    return test
+
+
+class MockCursor(object):
+    """The results of MockDB.find.  Objects are found as they are iterated
+    over, and it has the parts of pymongo's Cursor that maroon uses.  Unlike
+    a pymongo Cursor, every call to __iter__ runs the query again."""
+    def __init__(self, db, cls, q=None, sort_args=(), fields=None):
+        self._db = db
+        self._cls = cls
+        self._q = q
+        self._sort_args = list(sort_args)
+        self._fields = fields
+        self._limit = None
+        self._skip = 0
+        self._it = None
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip or 0
+        return self
+
+    def sort(self, key_or_list, direction=ASCENDING):
+        if isinstance(key_or_list, list):
+            self._sort_args = [(_field_name(k),d) for k,d in key_or_list]
+        else:
+            self._sort_args = [(_field_name(key_or_list),direction)]
+        return self
+
+    def clone(self):
+        cursor = MockCursor(self._db, self._cls, self._q, self._sort_args,
+                self._fields)
+        return cursor.skip(self._skip).limit(self._limit)
+
+    def rewind(self):
+        self._it = None
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        "count the results without building them"
+        if with_limit_and_skip:
+            limit, skip = self._limit, self._skip
+        else:
+            if not self._q:
+                return len(self._db.data[self._cls.__name__])
+            limit, skip = None, 0
+        return sum(1 for obj in
+                self._db._execute(self._cls, self._q, (), limit, skip))
+
+    def __len__(self):
+        return self.count(True)
+
+    def __iter__(self):
+        results = self._db._execute(
+                self._cls, self._q, self._sort_args, self._limit, self._skip)
+        if self._fields is None:
+            return results
+        names, fields = _projection(self._cls, self._fields)
+        return ( self._db._partial(self._cls, obj, names, fields)
+                for obj in results )
+
+    def next(self):
+        if self._it is None:
+            self._it = iter(self)
+        return next(self._it)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None,1):
+                raise IndexError("MockCursor does not support slice steps")
+            start = index.start or 0
+            stop = index.stop
+            if self._limit is not None:
+                stop = self._limit if stop is None else min(stop,self._limit)
+            limit = None if stop is None else stop-start
+            return self.clone().skip(self._skip+start).limit(
+                    None if limit is None else max(limit,0))
+        if index<0 or (self._limit is not None and index>=self._limit):
+            raise IndexError("no such item for MockCursor")
+        for obj in islice(iter(self), index, index+1):
+            return obj
+        raise IndexError("no such item for MockCursor")
+
+
+class _Desc(object):
+    "Wraps part of a sort key to reverse its order."
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+
+def _sort_key(long_names, sort_args):
+    """Build one key function for all the fields in sort_args.  Missing
+    fields sort first, like null does in mongo.  Returns the key and whether
+    the sort should be reversed."""
+    names = [long_names.get(name,name) for name,dir in sort_args]
+    dirs = [dir==DESCENDING for name,dir in sort_args]
+    reverse = all(dirs)
+    if reverse or not any(dirs):
+        def key(obj):
+            vals = []
+            for name in names:
+                val = getattr(obj,name,None)
+                vals.append((val is not None, val))
+            return vals
+    else:
+        def key(obj):
+            vals = []
+            for name,desc in zip(names,dirs):
+                val = getattr(obj,name,None)
+                val = (val is not None, val)
+                vals.append(_Desc(val) if desc else val)
+            return vals
+    return key, reverse
+
+
+def _union(plans):
+    def fetch():
+        ids = set()
+        for guess,ids_for in plans:
+            ids.update(ids_for())
+        return ids
+    return fetch
+
+
+def _hashable(val):
+    try:
+        hash(val)
+    except TypeError:
+        return False
     return True
+
+
+class _HashIndex(object):
+    "Maps the values of a field to the ids of the objects that have them."
+    def __init__(self, attr):
+        self.attr = attr
+        self.keys = defaultdict(set)
+        self.rev = {}
+        #objects that can't be indexed and have to be checked every time
+        self.loose = set()
+
+    def add(self, _id, val):
+        vals = val if isinstance(val,list) else (val,)
+        if not all(_hashable(v) for v in vals):
+            self.loose.add(_id)
+            return
+        vals = set(vals)
+        for v in vals:
+            self.keys[v].add(_id)
+        self.rev[_id] = vals
+
+    def build(self, items):
+        "add the (_id, val) pairs in items to an empty index"
+        for _id,val in items:
+            self.add(_id, val)
+
+    def remove(self, _id):
+        self.loose.discard(_id)
+        for v in self.rev.pop(_id,()):
+            ids = self.keys[v]
+            ids.discard(_id)
+            if not ids:
+                del self.keys[v]
+
+    def _lookup(self, goals):
+        goals = [g for g in goals if g in self.keys]
+        def fetch():
+            ids = set(self.loose)
+            for g in goals:
+                ids.update(self.keys[g])
+            return ids
+        guess = len(self.loose)+sum(len(self.keys[g]) for g in goals)
+        return guess, fetch
+
+    def plan(self, subq):
+        if not isinstance(subq,dict):
+            if hasattr(subq,'search') or not _hashable(subq):
+                return None
+            return self._lookup([subq])
+        goals = subq.get('$in')
+        if goals is None or not all(_hashable(g) for g in goals):
+            return None
+        return self._lookup(goals)
+
+
+class _SortedIndex(_HashIndex):
+    """Keeps the ids sorted by the value of a field, so that it can answer
+    range queries with bisect."""
+    def __init__(self, attr):
+        _HashIndex.__init__(self, attr)
+        self.vals = []
+        self.ids = []
+        self.nulls = set()
+
+    def add(self, _id, val):
+        if val is None:
+            self.nulls.add(_id)
+            return
+        if isinstance(val,(list,dict)):
+            self.loose.add(_id)
+            return
+        try:
+            i = bisect_right(self.vals, val)
+        except TypeError:
+            #python can't compare val to the other values
+            self.loose.add(_id)
+            return
+        self.vals.insert(i,val)
+        self.ids.insert(i,_id)
+        self.rev[_id] = val
+
+    def build(self, items):
+        #sort everything once instead of inserting into the lists one by one
+        pairs = []
+        for _id,val in items:
+            if val is None:
+                self.nulls.add(_id)
+            elif isinstance(val,(list,dict)):
+                self.loose.add(_id)
+            else:
+                pairs.append((val,_id))
+        try:
+            pairs.sort(key=itemgetter(0))
+        except TypeError:
+            #python can't compare some of the values, so add() sorts it out
+            for val,_id in pairs:
+                self.add(_id, val)
+            return
+        self.vals = [val for val,_id in pairs]
+        self.ids = [_id for val,_id in pairs]
+        self.rev = dict((_id,val) for val,_id in pairs)
+
+    def remove(self, _id):
+        self.loose.discard(_id)
+        self.nulls.discard(_id)
+        if _id not in self.rev:
+            return
+        val = self.rev.pop(_id)
+        lo = bisect_left(self.vals, val)
+        i = self.ids.index(_id, lo, bisect_right(self.vals, val))
+        del self.vals[i]
+        del self.ids[i]
+
+    def _range(self, lo, hi, extra=()):
+        ids = self.ids
+        def fetch():
+            found = set(ids[lo:hi])
+            found.update(self.loose)
+            found.update(extra)
+            return found
+        return (hi-lo)+len(self.loose)+len(extra), fetch
+
+    def _members(self, goals):
+        "find the objects whose value is in goals with a bisect for each goal"
+        vals, ids = self.vals, self.ids
+        spans, extra = [], ()
+        for goal in goals:
+            if goal is None:
+                extra = self.nulls
+            else:
+                spans.append((bisect_left(vals,goal), bisect_right(vals,goal)))
+        def fetch():
+            found = set(self.loose)
+            for lo,hi in spans:
+                found.update(ids[lo:hi])
+            found.update(extra)
+            return found
+        guess = sum(hi-lo for lo,hi in spans)+len(self.loose)+len(extra)
+        return guess, fetch
+
+    def plan(self, subq):
+        vals = self.vals
+        try:
+            if not isinstance(subq,dict):
+                if subq is None:
+                    return self._range(0, 0, self.nulls)
+                if hasattr(subq,'search'):
+                    return None
+                return self._range(
+                        bisect_left(vals,subq), bisect_right(vals,subq))
+            lo, hi = 0, len(vals)
+            found = False
+            for op,goal in subq.iteritems():
+                if goal is None or op not in _bounds:
+                    continue
+                found = True
+                if op=='$gt':
+                    lo = max(lo, bisect_right(vals,goal))
+                elif op=='$gte':
+                    lo = max(lo, bisect_left(vals,goal))
+                elif op=='$lt':
+                    hi = min(hi, bisect_left(vals,goal))
+                else:
+                    hi = min(hi, bisect_right(vals,goal))
+            best = self._range(lo, max(lo,hi)) if found else None
+            goals = subq.get('$in')
+            if isinstance(goals,list) and \
+                    not any(hasattr(g,'search') for g in goals):
+                members = self._members(goals)
+                if best is None or members[0]<best[0]:
+                    best = members
+        except TypeError:
+            return None
+        return best
+
+    def walk(self, desc=False):
+        "yields the ids in order, None sorts first"
+        if desc:
+            return chain(reversed(self.ids), self.nulls)
+        return chain(self.nulls, self.ids)
+
+
+_bounds = ('$gt','$gte','$lt','$lte')
@@ -3,24 +3,60 @@ maroon models - simplified object-relational mapper for Python and MongoDB
 by Jeremy Kelley <jeremy@33ad.org> and Jeff McGee <JeffAMcGee@gmail.com>
 '''
 
+from functools import partial
+
 import pymongo
-from maroondb import MaroonDB
+from maroondb import MaroonDB, _chunks, _pipeline, _projection
+from maroondb import _interleave, _ranges
 
 
 class MongoDB(pymongo.database.Database,MaroonDB):
-    def __init__(self, connection=None, name='maroon', **kwargs):
+    doc_format = dict(dateformat="datetime")
+
+    def __init__(self, connection=None, name='maroon', verify=False, **kwargs):
         if connection==None:
             connection = pymongo.Connection(**kwargs)
         pymongo.database.Database.__init__(self,connection,name)
+        self.verify = verify
+
+    def healthy(self):
+        try:
+            return bool(self.command('ping').get('ok'))
+        except pymongo.errors.PyMongoError:
+            return False
 
     def _coll(self, model):
         return self[model.__class__.__name__]
 
-    def bulk_save_models(self, models, cls=None):
-        if models:
-            if cls == None:
-                cls=models[0].__class__
-            self[cls.__name__].insert(m.to_d(dateformat="datetime") for m in models)
+    def bulk_save_models(self, models, cls=None, chunk_size=1000,
+            ordered=True, workers=1):
+        """Insert models chunk_size at a time, with up to workers inserts
+        running at once.  If ordered is False, mongo keeps inserting after a
+        document fails, later chunks are still sent, and the first error is
+        raised at the end.  If it is True, the chunks are sent one at a time
+        so that nothing after a failed document is inserted, and workers is
+        ignored.  The _id of each model is set as it is inserted."""
+        if ordered:
+            workers = 1
+        def insert(chunk):
+            kind = cls or chunk[0].__class__
+            ds = kind.to_dicts(chunk, dateformat="datetime")
+            coll = self[kind.__name__]
+            try:
+                #w=1, or the errors never make it back to us
+                coll.insert(ds, continue_on_error=not ordered, w=1)
+            except Exception, e:
+                if ordered:
+                    raise
+                return e
+            finally:
+                for m,d in zip(chunk,ds):
+                    m._id = d.get('_id')
+        errors = [ e for e in
+            _pipeline(insert, _chunks(models, chunk_size), workers)
+            if e is not None ]
+        if errors:
+            raise errors[0]
 
     def save(self, model):
         d = model.to_d(dateformat="datetime")
@@ -37,15 +73,95 @@ class MongoDB(pymongo.database.Database,MaroonDB):
             upsert=True,
             )
 
-    def get_id(self, cls, _id, **kwargs):
+    def update_changed(self, model):
+        if model.changed() is None:
+            return self.merge(model)
+        sets, unsets = model._changes(dateformat="datetime")
+        sets.pop('_id',None)
+        update = {}
+        if sets:
+            update['$set'] = sets
+        if unsets:
+            update['$unset'] = dict.fromkeys(unsets,1)
+        if update:
+            self._coll(model).update({'_id':model._id}, update)
+
+    def update_where(self, cls, q, update, multi=True):
+        try:
+            q = q.to_mongo_dict()
+        except AttributeError:
+            pass
+        res = self[cls.__name__].update(
+                q or {},
+                update.to_mongo_dict(**self.doc_format),
+                multi=multi,
+                w=1, #acknowledge the write, so that the count comes back
+                )
+        return res['n']
+
+    def get_id(self, cls, _id, fields=None, **kwargs):
+        names, fields = _projection(cls, fields)
+        if names:
+            kwargs['fields'] = names
         d = self[cls.__name__].find_one(_id, **kwargs)
-        return cls(d) if d else None
+        return self._load(cls,d,fields=fields) if d else None
 
     def get_all(self, cls, **kwargs):
         return self.find(cls,None,**kwargs)
 
-    def find(self, cls, q, limit=None, where=None, **kwargs):
+    def find(self, cls, q, limit=None, where=None, lazy=False, fields=None,
+            **kwargs):
+        names, fields = _projection(cls, fields)
+        cursor = self._cursor(cls, q, limit, where, names, **kwargs)
+        return (self._load(cls,d,lazy,fields) for d in cursor)
+
+    def find_docs(self, cls, q=None, limit=None, where=None, fields=None,
+            **kwargs):
+        names = _projection(cls, fields)[0]
+        return self._cursor(cls, q, limit, where, names, **kwargs)
+
+    def parallel_scan(self, cls, q=None, workers=4, lazy=False, fields=None):
+        """Split the documents that match q into workers ranges of _id, and
+        read the ranges at the same time.  Objects are yielded in the order
+        they arrive."""
+        coll = self[cls.__name__]
+        names, fields = _projection(cls, fields)
+        try:
+            q = q.to_mongo_dict()
+        except AttributeError:
+            pass
+        q = dict(q or {})
+        #a query on _id is already a range, so it is not split
+        splits = [] if '_id' in q else self._splits(coll, q, workers)
+        def scan(start, end):
+            rq = dict(q)
+            bounds = {}
+            if start is not None:
+                bounds['$gte'] = start
+            if end is not None:
+                bounds['$lt'] = end
+            if bounds:
+                rq['_id'] = bounds
+            cursor = coll.find(rq, fields=names)
+            return (self._load(cls,d,lazy,fields) for d in cursor)
+        return _interleave(
+            [partial(scan, *r) for r in _ranges(splits)], workers)
+
+    def _splits(self, coll, q, parts):
+        "pick the _ids that split the documents matching q into parts ranges"
+        count = coll.find(q).count()
+        splits = []
+        for i in xrange(1, parts):
+            cursor = coll.find(q, fields=['_id']).sort('_id',pymongo.ASCENDING)
+            for d in cursor.skip(count*i//parts).limit(1):
+                if not splits or splits[-1]!=d['_id']:
+                    splits.append(d['_id'])
+        return splits
+
+    def _cursor(self, cls, q, limit, where, names, **kwargs):
         coll = self[cls.__name__]
+        if names:
+            kwargs['fields'] = names
         try:
             q = q.to_mongo_dict()
         except AttributeError:
@@ -59,7 +175,7 @@ class MongoDB(pymongo.database.Database,MaroonDB):
             cursor.where(where)
         if limit != None:
             cursor.limit(limit)
-        return (cls(d) for d in cursor)
+        return cursor
 
     def in_coll(self, cls, _id):
         return bool(self[cls.__name__].find(dict(_id=_id)).count())
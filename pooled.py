@@ -0,0 +1,171 @@
+'''
+maroon models - simplified object-relational mapper for Python and MongoDB
+by Jeremy Kelley <jeremy@33ad.org> and Jeff McGee <JeffAMcGee@gmail.com>
+'''
+
+from contextlib import contextmanager
+import threading
+import time
+
+
+class PoolTimeout(Exception): pass
+
+
+class _Binding(object):
+    "a thread's database, which goes back to the pool when the thread ends"
+    def __init__(self, pool, db):
+        self.pool = pool
+        self.db = db
+
+    def __del__(self):
+        if self.db is not None:
+            self.pool.checkin(self.db)
+
+
+#We do not extend MaroonDB because we want to call the methods in the pool
+class PooledDB(object):
+    """Keeps up to size databases made by factory() and binds one to each
+    thread that uses it, so threads do not share a connection:
+
+        Model.database = PooledDB(lambda: MongoDB(name='maroon'), size=8)
+
+    A thread keeps its database until it calls release() or ends.  Use
+    bound() to hold one for a single task instead.  Databases that sat idle
+    for check_after seconds are checked with check(db) before they are
+    handed out, and replaced if it returns False or raises.  By default
+    check calls db.healthy().  To log writes, wrap the pool in a TeeDB
+    instead of pooling TeeDBs, so there is only one log file."""
+    def __init__(self, factory, size=4, timeout=None, check=None,
+            check_after=30, clock=time.time):
+        self._factory = factory
+        self._size = size
+        self._timeout = timeout
+        self._check = check or _healthy
+        self._check_after = check_after
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._idle = [] #(db, time it was checked in)
+        self._created = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.discarded = 0
+
+    def checkout(self, timeout=None):
+        """take a database out of the pool, waiting up to timeout seconds for
+        one to be checked in if size are in use"""
+        if timeout is None:
+            timeout = self._timeout
+        start = self._clock()
+        while True:
+            db, since = self._take(start, timeout)
+            if db is None:
+                try:
+                    db = self._factory()
+                except Exception:
+                    self._forget()
+                    raise
+            elif self._clock()-since >= self._check_after and not self._ok(db):
+                self._forget()
+                continue
+            with self._cond:
+                self.checkouts += 1
+                self.wait_time += self._clock()-start
+            return db
+
+    def _take(self, start, timeout):
+        "returns an idle database, or (None,None) if a new one can be made"
+        with self._cond:
+            waited = False
+            while not self._idle and self._created>=self._size:
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                if timeout is None:
+                    self._cond.wait()
+                    continue
+                left = start+timeout-self._clock()
+                if left<=0:
+                    self.timeouts += 1
+                    raise PoolTimeout(
+                        "all %d databases are in use"%self._size)
+                self._cond.wait(left)
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+            return None, None
+
+    def _ok(self, db):
+        try:
+            return self._check(db)
+        except Exception:
+            return False
+
+    def _forget(self):
+        "a database that was counted against size is gone"
+        with self._cond:
+            self._created -= 1
+            self.discarded += 1
+            self._cond.notify()
+
+    def checkin(self, db):
+        with self._cond:
+            self._idle.append((db, self._clock()))
+            self._cond.notify()
+
+    def current(self):
+        "returns the database bound to this thread, checking one out if needed"
+        binding = getattr(self._local, 'binding', None)
+        if binding is None:
+            binding = self._local.binding = _Binding(self, self.checkout())
+        return binding.db
+
+    def release(self):
+        "return the database bound to this thread to the pool"
+        binding = getattr(self._local, 'binding', None)
+        if binding is not None:
+            db, binding.db = binding.db, None
+            del self._local.binding
+            self.checkin(db)
+
+    @contextmanager
+    def bound(self):
+        """bind a database to this thread for the length of a with block,
+        and then release it"""
+        held = getattr(self._local, 'binding', None) is not None
+        try:
+            yield self.current()
+        finally:
+            if not held:
+                self.release()
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            return dict(
+                size=self._size,
+                created=self._created,
+                idle=idle,
+                in_use=self._created-idle,
+                checkouts=self.checkouts,
+                waits=self.waits,
+                wait_time=self.wait_time,
+                timeouts=self.timeouts,
+                discarded=self.discarded,
+                )
+
+    def __getitem__(self, name):
+        return self.current()[name]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            #do not open a connection for copy, pickle and friends
+            raise AttributeError(name)
+        return getattr(self.current(), name)
+
+
+def _healthy(db):
+    healthy = getattr(db, 'healthy', None)
+    return healthy() if healthy else True
@@ -10,6 +10,7 @@ done
 echo "running mock"
 python database_tests.py mock
 python query_tests.py mock
+python query_tests.py mockindex
 
 echo "running couch"
 python database_tests.py couch
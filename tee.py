@@ -20,11 +20,16 @@ class TeeDB(object):
     def _log(self,model):
         print>>self._f,json.dumps(model.to_d())
 
-    def bulk_save_models(self, models, *args):
+    def bulk_save_models(self, models, *args, **kwargs):
+        return self._db.bulk_save_models(self._logged(models), *args, **kwargs)
+
+    def _logged(self, models):
+        #log the models as the database reads them, so that models can be
+        #a generator
         for model in models:
             self._log(model)
+            yield model
         self._f.flush()
-        return self._db.bulk_save_models(models, *args)
 
     def save(self, model):
         self._log(model)
@@ -4,12 +4,13 @@ import sys
 sys.path.append("..")
 
 import unittest
+import copy
 from datetime import datetime
 
 import maroon
-from maroon import Model, IntProperty, Property
+from maroon import Model, ModelPart, ModelProperty, IntProperty, Property, Q
 
-from models import SimpleModel, FunModel, PersonModel
+from models import SimpleModel, FunModel, PersonModel, PointModel
 
 class TestBasicModelCreationAndAssignment(unittest.TestCase):
 
@@ -101,6 +102,190 @@ class TestBasicModelCreationAndAssignment(unittest.TestCase):
         self.failUnlessEqual(SimpleModel.long_names,
                 {'i1':'int1','i2':'int2','_rev':'_rev','_id':'_id'})
 
+    def test_hydration_plan(self):
+        self.failUnlessEqual(SimpleModel._plan['i1'][0], 'int1')
+        self.failUnlessEqual(SimpleModel._plan['int1'][0], 'int1')
+        obj = SimpleModel(dict(i1='4', int2=5, other=6))
+        self.failUnlessEqual( 4, obj.int1 )
+        self.failUnlessEqual( 5, obj.int2 )
+        self.failUnlessEqual( 6, obj.other )
+        self.assertRaises(ValueError, SimpleModel, dict(i1='bogus'))
+        #defaults are built per instance
+        a = FunModel()
+        self.failIf( a.created is None )
+
+    def test_from_db(self):
+        fun = FunModel.from_db(dict(
+            e='red', dt=[2005,1,2,13], ns=['a','b'], me={'n':'jeff'}))
+        self.assertEqual(fun.enum, 'red')
+        self.assertEqual(fun.date, datetime(2005,1,2,13))
+        self.assertEqual(fun.part.name, 'jeff')
+        self.assertEqual(fun.part.age, 7)
+        self.failIf( fun.created is None )
+        self.assertRaises(TypeError, fun.names.__setitem__, 0, 7)
+        #values are trusted, so nothing is validated
+        self.assertEqual(SimpleModel.from_db({'i1':'3'}).int1, '3')
+
+    def test_lazy_from_db(self):
+        part = {'n':'jeff', 'a':30}
+        d = dict(e='red', dt=datetime(2005,1,2,13), me=part, x=1)
+        fun = FunModel.from_db(d, lazy=True, dateformat='datetime')
+        self.failIf( 'part' in fun.__dict__ )
+        self.assertEqual(fun.x, 1)
+        self.assertEqual(fun.enum, 'red')
+        self.failUnless( 'enum' in fun.__dict__ )
+        #untouched fields are copied from the raw document
+        self.failUnless( fun.to_d(dateformat='datetime')['me'] is part )
+        self.assertEqual(fun.to_d()['dt'], (2005,1,2,13,0,0))
+        self.assertEqual(fun.part.age, 30)
+        fun.date = None
+        self.failIf( 'dt' in fun.to_d() )
+
+    def test_compact(self):
+        p = PointModel(x='3', label='home')
+        self.failUnless( '_s_x' in PointModel.__slots__ )
+        #the fields really are in slots, there is no dict per object
+        self.assertEqual(PointModel.__dictoffset__, 0)
+        self.failIf( type(p.__dict__) is dict )
+        self.assertEqual(PointModel._s_x.__get__(p), 3)
+        plain = SimpleModel(int1=3, int2=0)
+        self.failUnless( sys.getsizeof(PointModel(x=3)) <
+                sys.getsizeof(plain)+sys.getsizeof(vars(plain)) )
+        self.assertEqual(p.x, 3)
+        self.assertEqual(p.y, 0)
+        self.assertEqual(p.label, 'home')
+        self.assertRaises(ValueError, setattr, p, 'x', 'bogus')
+        self.assertRaises(AttributeError, getattr, p, 'z')
+        p.update({'y':5, 'w':[2005,1,2]})
+        self.assertEqual(p.when, datetime(2005,1,2))
+        self.assertEqual(p.to_d(dateformat='datetime'),
+                {'x':3, 'y':5, 'w':datetime(2005,1,2), 'label':'home'})
+        self.failUnless( repr(p).startswith('PointModel(') )
+        q = PointModel.from_db({'x':1,'w':datetime(2005,1,2)}, lazy=True,
+                dateformat='datetime')
+        self.assertEqual(q.to_d(), {'x':1, 'y':0, 'w':(2005,1,2,0,0,0)})
+        self.assertEqual(copy.copy(q).to_d(), q.to_d())
+        #the bookkeeping of loaded objects has slots too
+        r = PointModel.from_db({'x':1,'y':2}, fields=['x','y'])
+        r.x = 4
+        self.assertEqual(r.changed(), set(['x']))
+        self.assertRaises(AttributeError, getattr, r, '_extra')
+        self.assertEqual(sys.getsizeof(r), sys.getsizeof(p))
+
+    def test_plain_part(self):
+        #ModelPart and Model have no __dict__ of their own, but still work
+        part = ModelPart({'a':1}, b=2)
+        self.assertEqual((part.a, part.b), (1,2))
+        self.failUnless( isinstance(part, ModelPart) )
+        self.assertEqual(Model(_id='x', c=3).to_d(), {'_id':'x', 'c':3})
+        class Holder(Model):
+            part = ModelProperty('p', ModelPart)
+        held = Holder(part={'z':2})
+        self.assertEqual(held.part.z, 2)
+        self.assertEqual(Holder.from_db({'p':{'z':3}}).part.to_d(), {'z':3})
+
+    def test_changed(self):
+        self.assertEqual(SimpleModel(int1=1).changed(), None)
+        fun = FunModel.from_db(dict(e='red', ns=['a'], me={'n':'jeff'}))
+        self.assertEqual(fun.changed(), set())
+        #clean objects have no marker at all, so loading them is cheap
+        self.failIf( '_dirty' in vars(fun) )
+        fun.part.age = 8
+        fun.names.append('b')
+        fun.update({'f':2.5})
+        self.assertEqual(fun.changed(), set(['part','names','real']))
+        sets, unsets = fun._changes()
+        self.assertEqual(sets, {'me':{'n':'jeff','a':8}, 'ns':['a','b'], 'f':2.5})
+        fun.mark_clean()
+        fun.enum = None
+        self.assertEqual(fun._changes(), ({}, ['e']))
+        self.failIf( '_dirty' in fun.to_d() )
+
+    def test_to_dicts(self):
+        when = datetime(2010,1,2,3,4,5)
+        funs = [
+            FunModel(enum='red', date=when, names=['a'],
+                part=PersonModel(name='jeff')),
+            FunModel(real=2.5, dic={'x':1}),
+            FunModel.from_db(dict(dt=when, me={'n':'kate'}), lazy=True),
+            PointModel(x=1, when=when),
+            ]
+        funs[1].secret = 'shh'
+        funs[1].extra = 7
+        for kwargs in ({}, {'dateformat':'epoch'}, {'long_names':True}):
+            self.assertEqual(FunModel.to_dicts(funs, **kwargs),
+                    [f.to_d(**kwargs) for f in funs])
+            self.assertEqual(PointModel.to_dicts(funs[3:], **kwargs),
+                    [funs[3].to_d(**kwargs)])
+
+    def test_query_normalization(self):
+        n, f = SimpleModel.int1, SimpleModel.int2
+        q = (n==1)|(n==2)|(n==1)|(n.is_in([2,3]))
+        self.assertEqual(q.to_mongo_dict(), {'i1':{'$in':[1,2,3]}})
+        q = ((n==1)|(f==2)) & ((n==2)|(f==2))
+        self.assertEqual(q.to_mongo_dict(),
+                {'$or':[{'i1':1,'i2':2}, {'i1':2,'i2':2}, {'i2':2}]})
+        q = ((n==1)|(f==2)) & ((n==3)|(f==4))
+        self.assertEqual(q.to_mongo_dict(),
+                {'$or':[{'i1':1,'i2':4}, {'i1':3,'i2':2}]})
+        self.assertEqual(((n==1)|(n==2)|Q({})).to_mongo_dict(), {})
+        #ranges are not contradictions, so they are never dropped
+        self.assertRaises(maroon.BogusQuery,
+                lambda: ((n>=5)|(f==1)) & ((n>=10)|(f==2)))
+        q = ((n==5)|(f==1)) & ((n>=3)|(f==2))
+        self.assertEqual(q.to_mongo_dict(), {'$or':[
+                {'i1':5}, {'i1':5,'i2':2}, {'i1':{'$gte':3},'i2':1}]})
+        q = ((n>=5)|(f==1)) & ((n<3)|(f==2))
+        self.assertEqual(q.to_mongo_dict(), {'$or':[
+                {'i1':{'$gte':5},'i2':2}, {'i1':{'$lt':3},'i2':1}]})
+        #a list can hold both values, so only scalar fields are dropped
+        ns = FunModel.names
+        self.assertRaises(maroon.BogusQuery,
+                lambda: ((ns=='a')|(n==1)) & ((ns=='b')|(n==2)))
+        q = ((ns=='a')|(n==1)) & ((ns>'c')|(n==2))
+        self.assertRaises(maroon.BogusQuery, q.to_mongo_dict)
+        q = ((ns=='d')|(n==1)) & ((ns>'c')|(n==2))
+        self.assertEqual(q.to_mongo_dict(), {'$or':[{'ns':'d'},
+                {'ns':'d','i1':2}, {'ns':{'$gt':'c'},'i1':1}]})
+        #huge ORs are folded before they get distributed
+        q = reduce(Q.__or__, [n==x for x in xrange(500)]) & \
+                reduce(Q.__or__, [f==x for x in xrange(500)])
+        self.assertEqual(len(q.to_mongo_dict()['i2']['$in']), 500)
+
+    def test_to_mongo_dict(self):
+        n, f = SimpleModel.int1, SimpleModel.int2
+        self.assertEqual(((n>=4) & (f==5) & (n<9)).to_mongo_dict(),
+                {'i1':{'$gte':4,'$lt':9},'i2':5})
+        self.assertEqual(((n==4) | (f==5)).to_mongo_dict(),
+                {'$or':[{'i1':4},{'i2':5}]})
+        self.assertRaises(maroon.BogusQuery,
+                ((n==1) & (n>2)).to_mongo_dict)
+
+    def test_update_ops(self):
+        when = datetime(2010,1,2,3,4,5)
+        u = FunModel.real.inc(2) & FunModel.names.push('a','b') & \
+                FunModel.date.set(when) & FunModel.enum.unset()
+        self.assertEqual(u.to_mongo_dict(), {
+            '$inc':{'f':2},
+            '$push':{'ns':{'$each':['a','b']}},
+            '$set':{'dt':(2010,1,2,3,4,5)},
+            '$unset':{'e':1},
+            })
+        self.assertRaises(maroon.BogusQuery,
+                u.__and__, FunModel.real.set(3))
+        self.assertRaises(TypeError, FunModel.names.push, 7)
+        fun = FunModel(real=1.5, names=['a'], enum='red')
+        (u & FunModel.dic.set({'x':1})).apply(fun)
+        self.assertEqual(fun.real, 3.5)
+        self.assertEqual(fun.names, ['a','a','b'])
+        self.assertEqual(fun.date, when)
+        self.assertEqual(fun.enum, None)
+        (FunModel.names.add_to_set('b','c') & FunModel.part.set(
+                PersonModel(name='jeff'))).apply(fun)
+        self.assertEqual(fun.names, ['a','a','b','c'])
+        FunModel.names.pull('a').apply(fun)
+        self.assertEqual(fun.names, ['b','c'])
+
 
 if __name__ == '__main__':
     unittest.main()
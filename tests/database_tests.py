@@ -16,6 +16,16 @@ from couch import CouchDB
 from models import SimpleModel, FunModel, PersonModel
 
 
+def needs_find(test):
+    "CouchDB can't run queries, so skip the tests that call find()"
+    def run(self):
+        if not hasattr(FunModel.database, 'find'):
+            self.skipTest("the database can't run queries")
+        return test(self)
+    run.__name__ = test.__name__
+    return run
+
+
 class TestBasicModelCreationAndAssignment(unittest.TestCase):
 
     def setUp(self):
@@ -50,6 +60,22 @@ class TestBasicModelCreationAndAssignment(unittest.TestCase):
         ob.pop('_rev',None)
         self.failUnlessEqual(ob, dict(_id='7', e='red', d={'three':4}))
 
+    def test_bulk_save_duplicates(self):
+        if isinstance(SimpleModel.database, MockDB):
+            self.skipTest("MockDB replaces documents with the same _id")
+        dups = lambda name: [SimpleModel(_id=name, int1=1),
+                SimpleModel(_id=name, int1=2), SimpleModel(_id=name+'2')]
+        #an ordered save stops at the duplicate
+        self.assertRaises(Exception, SimpleModel.bulk_save, dups('kiara'),
+                chunk_size=1, workers=2)
+        self.failUnlessEqual(SimpleModel.get_id('kiara').int1, 1)
+        self.failUnlessEqual(SimpleModel.get_id('kiara2'), None)
+        #an unordered one saves the rest before it raises
+        self.assertRaises(Exception, SimpleModel.bulk_save, dups('kovu'),
+                chunk_size=1, ordered=False, workers=2)
+        self.failIfEqual(SimpleModel.get_id('kovu'), None)
+        self.failIfEqual(SimpleModel.get_id('kovu2'), None)
+
     def test_missing_fields(self):
         obj1 = SimpleModel({'_id':'simba','i1':2})
         obj1.save()
@@ -114,6 +140,70 @@ class TestBasicModelCreationAndAssignment(unittest.TestCase):
         self.failUnlessEqual( fun.part.name, "scar")
         self.failUnlessEqual( fun.part.age, 32)
 
+    @needs_find
+    def test_fields(self):
+        FunModel(_id='pride', enum='blue', real=2.5).save()
+        ob = FunModel.get_id('pride', fields=[FunModel.real])
+        self.failUnlessEqual(ob.real, 2.5)
+        self.assertRaises(AttributeError, getattr, ob, 'enum')
+        self.assertRaises(maroon.PartialModelError, ob.save)
+        ob.real = 4.5
+        ob.merge()
+        res = list(FunModel.find(FunModel.real==4.5, fields=['e']))
+        self.failUnlessEqual([f.enum for f in res], ['blue'])
+        self.failIf( 'f' in res[0].to_d() )
+
+    def test_update_changed(self):
+        FunModel(_id='dirty', enum='red', real=1.5, names=['a'],
+                part=PersonModel(name='nala')).save()
+        fun = FunModel.get_id('dirty')
+        fun.part.age = 5
+        fun.names.append('b')
+        fun.real = None
+        fun.update_changed()
+        fun = FunModel.get_id('dirty')
+        self.failUnlessEqual(fun.part.age, 5)
+        self.failUnlessEqual(fun.names, ['a','b'])
+        self.failUnlessEqual(fun.real, None)
+        self.failUnlessEqual(fun.enum, 'red')
+
+    @needs_find
+    def test_update_where(self):
+        for _id in ('zazu','rafiki'):
+            FunModel(_id=_id, enum='blue', real=1.25, names=['x']).save()
+        count = FunModel.update_where(
+                FunModel.real==1.25,
+                FunModel.real.inc(2),
+                FunModel.names.push('y'),
+                )
+        self.failUnlessEqual(count, 2)
+        for _id in ('zazu','rafiki'):
+            fun = FunModel.get_id(_id)
+            self.failUnlessEqual(fun.real, 3.25)
+            self.failUnlessEqual(fun.names, ['x','y'])
+        count = FunModel.update_where(
+                FunModel._id=='zazu',
+                FunModel.names.add_to_set('x','z'),
+                FunModel.enum.unset(),
+                )
+        self.failUnlessEqual(count, 1)
+        fun = FunModel.get_id('zazu')
+        self.failUnlessEqual(fun.names, ['x','y','z'])
+        self.failUnlessEqual(fun.enum, None)
+
+    @needs_find
+    def test_find_columns(self):
+        when = datetime.datetime(2010,1,2,3,4,5)
+        FunModel(_id='pumbaa', enum='red', real=1.5, date=when).save()
+        cols = FunModel.find_columns(FunModel._id=='pumbaa',
+                fields=[FunModel.date, FunModel.real, 'e', 'me'])
+        self.failUnlessEqual(sorted(cols), ['date','enum','part','real'])
+        self.failUnlessEqual(cols['date'].typecode, 'l')
+        self.failUnlessEqual(list(cols['date']), [1262401445])
+        self.failUnlessEqual(list(cols['real']), [1.5])
+        self.failUnlessEqual(cols['enum'], ['red'])
+        self.failUnlessEqual(cols['part'], [None])
+
 
 if __name__ == '__main__':
     db = sys.argv[1]
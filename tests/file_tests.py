@@ -6,11 +6,24 @@ import os
 import unittest
 import json
 import tempfile
+import threading
+import time
+import operator
+import urlparse
+import BaseHTTPServer
+import SocketServer
 
 import maroon
+import maroondb
+import mock
 from mock import MockDB
 from mongo import MongoDB
+import couchdbkit
+from couch import CouchDB
 from tee import TeeDB
+from buffered import BufferedDB, BufferedSaveError
+from asyncdb import AsyncDB
+from pooled import PooledDB, PoolTimeout
 
 from models import PersonModel, SimpleModel
 import models
@@ -56,6 +69,12 @@ class TestTee(unittest.TestCase):
         g = PersonModel.get_id(3)
         self.failUnlessEqual(50, g.age)
 
+def _age(person):
+    if person.age<0:
+        raise ValueError("negative age")
+    return person.age
+
+
 class TestMock(unittest.TestCase):
     def setUp(self):
         maroon.Model.database = MockDB("mockdb",models)
@@ -75,6 +94,557 @@ class TestMock(unittest.TestCase):
         self.failUnlessEqual(darby.name,"Darby")
         self.failUnlessEqual(darby.age,3)
 
+    def test_compiled_query(self):
+        db = maroon.Model.database
+        titus = PersonModel.find(PersonModel.name=='Titus')
+        self.failUnlessEqual(len(titus),1)
+        self.failUnlessEqual(titus[0].age,7)
+        res = PersonModel.find(PersonModel.name=='Darby')
+        self.failUnlessEqual(res[0].age,3)
+        #the second query only differs by value, so it reuses the predicate
+        self.failUnlessEqual(len(db._predicates),1)
+        res = PersonModel.find((PersonModel.age<5)|(PersonModel.name//'^T'))
+        self.failUnlessEqual(len(res),2)
+        self.failUnlessEqual(len(db._predicates),2)
+        #queries with many shapes do not grow it without bound
+        limit, mock._PREDICATE_LIMIT = mock._PREDICATE_LIMIT, 3
+        try:
+            for age in xrange(1,6):
+                PersonModel.find(reduce(operator.or_,
+                    [PersonModel.age==a for a in xrange(age)]))
+            self.failUnless(len(db._predicates)<=3)
+        finally:
+            mock._PREDICATE_LIMIT = limit
+
+    def test_sort_limit(self):
+        for i,(a,b) in enumerate([(3,1),(None,2),(3,5),(1,None),(2,4)]):
+            SimpleModel(_id=i, int1=a, int2=b).save()
+        def ids(**kwargs):
+            return [m._id for m in SimpleModel.find(**kwargs)]
+        self.failUnlessEqual(ids(sort=SimpleModel.int1), [1,3,4,0,2])
+        self.failUnlessEqual(ids(sort='i1', desc=True, limit=3), [0,2,4])
+        self.failUnlessEqual(ids(sort_list=['i1',('i2',-1)], limit=4),
+                [1,3,4,2])
+        self.failUnlessEqual(ids(sort_list=[('i1',-1),'i2'], limit=2), [0,2])
+
+    def test_cursor(self):
+        for i in xrange(10):
+            SimpleModel(_id=i, int1=i).save()
+        res = SimpleModel.find(SimpleModel.int1>=3, sort='i1', skip=2)
+        self.failUnlessEqual(res.count(), 7)
+        self.failUnlessEqual([m.int1 for m in res.limit(3)], [5,6,7])
+        self.failUnlessEqual(res.count(with_limit_and_skip=True), 3)
+        self.failUnlessEqual([m.int1 for m in res[1:]], [6,7])
+        self.failUnlessEqual(res[2].int1, 7)
+        self.assertRaises(IndexError, lambda: res[3])
+        self.failUnlessEqual(res.next().int1, 5)
+        self.failUnlessEqual(res.next().int1, 6)
+        res = SimpleModel.find().sort('i1',-1).skip(8)
+        self.failUnlessEqual([m.int1 for m in res], [1,0])
+        self.failUnlessEqual(SimpleModel.find(limit=4).count(True), 4)
+
+    def test_cache(self):
+        for i in xrange(6):
+            SimpleModel(_id=i, int1=i).save()
+        cache = maroon.ModelCache(SimpleModel, limit=3, policy=maroon.LRUPolicy())
+        for i in [0,1,2,0,3]:
+            self.failUnlessEqual(cache[i].int1, i)
+        self.failUnlessEqual(sorted(cache), [0,2,3])
+        self.failUnlessEqual(cache.stats()['hits'], 1)
+        self.failUnlessEqual(cache.stats()['misses'], 4)
+        self.failUnlessEqual(cache.stats()['evictions'], 1)
+
+        cache = maroon.ModelCache(SimpleModel, limit=2,
+                policy=maroon.TinyLFUPolicy())
+        for i in [0,0,1,1,0,1]:
+            cache[i]
+        #4 has only been seen once, so it is not worth dropping 0 or 1
+        self.failUnlessEqual(cache[4].int1, 4)
+        self.failUnlessEqual(sorted(cache), [0,1])
+        self.failUnlessEqual(cache.rejections, 1)
+
+        cache = maroon.ModelCache(SimpleModel, max_bytes=250,
+                sizeof=lambda obj: 100)
+        for i in xrange(4):
+            cache[i]
+        self.failUnlessEqual(len(cache), 2)
+        self.failUnlessEqual(cache.bytes, 200)
+
+        #the dict methods keep the bookkeeping too
+        cache = maroon.ModelCache(SimpleModel, limit=2,
+                policy=maroon.LRUPolicy(), max_bytes=1000,
+                sizeof=lambda obj: 100)
+        cache[0], cache[1]
+        self.failUnlessEqual(cache.pop(0).int1, 0)
+        self.failUnlessEqual(cache.pop(0, None), None)
+        self.failUnlessEqual(cache.bytes, 100)
+        cache.update({2:cache[2], 3:cache[3]})
+        self.failUnlessEqual(sorted(cache), [2,3])
+        self.failUnlessEqual(cache.setdefault(3).int1, 3)
+        key, obj = cache.popitem()
+        self.failUnlessEqual(key, obj._id)
+        cache.clear()
+        self.failUnlessEqual(cache.bytes, 0)
+        cache[4], cache[5], cache[0]
+        self.failUnlessEqual(sorted(cache), [0,5])
+
+    def test_cache_ttl(self):
+        now = [0]
+        for i in xrange(3):
+            SimpleModel(_id=i, int1=i).save()
+        cache = maroon.ModelCache(SimpleModel, ttl=10, negative_ttl=2,
+                refresh_ahead=0.5, clock=lambda: now[0])
+        cache.ensure_ids([0,1,7])
+        self.failUnless( 7 in cache )
+        self.failUnlessEqual(cache[7], None)
+        now[0] = 3
+        self.failIf( 7 in cache )
+        SimpleModel(_id=0, int1=100).save()
+        now[0] = 6
+        #past the refresh point, so this is still the old object
+        self.failUnlessEqual(cache[0].int1, 0)
+        cache.refresh()
+        self.failUnlessEqual(cache[0].int1, 100)
+        self.failUnlessEqual(cache.refreshes, 1)
+        now[0] = 11
+        self.failIf( 1 in cache )
+        self.failUnlessEqual(cache[1].int1, 1)
+        self.failUnlessEqual(cache.stats()['expirations'], 2)
+        #reading it like a dict does not return expired entries either
+        now[0] = 30
+        self.failUnlessEqual(cache.get(1), None)
+        cache.set(2, cache[2], ttl=100)
+        self.failUnlessEqual(cache.get(2).int1, 2)
+        self.failUnlessEqual(cache.keys(), [2])
+        self.failUnlessEqual([obj.int1 for obj in cache.values()], [2])
+        self.failUnlessEqual(list(cache.iteritems()), cache.items())
+        self.failUnlessEqual(cache.stats()['size'], 1)
+
+    def test_ensure_ids(self):
+        for i in xrange(10):
+            SimpleModel(_id=i, int1=i).save()
+        cache = maroon.ModelCache(SimpleModel, chunk_size=3, workers=2)
+        cache[0]
+        res = cache.ensure_ids(range(12)+[5])
+        self.failUnlessEqual(res, dict(requested=12, hits=1, loaded=9,
+                missing=2, queries=4, saved=7))
+        self.failUnlessEqual(cache[9].int1, 9)
+        self.failUnlessEqual(cache[11], None)
+        self.failUnlessEqual(cache.misses, 1)
+
+    def test_single_flight(self):
+        db = maroon.Model.database
+        calls = []
+        def get_ids(cls, ids, **kwargs):
+            calls.append(sorted(ids))
+            return MockDB.get_ids(db, cls, ids)
+        db.get_ids = get_ids
+        loading = threading.Event()
+        def get_id(cls, _id, **kwargs):
+            if _id==3:
+                loading.set()
+                time.sleep(0.1)
+            return MockDB.get_id(db, cls, _id)
+        db.get_id = get_id
+        for i in xrange(4):
+            SimpleModel(_id=i, int1=i).save()
+        #a lone miss does not wait for the batch window
+        cache = maroon.ThreadSafeModelCache(SimpleModel, batch_window=10)
+        start = time.time()
+        self.failUnlessEqual(cache[0].int1, 0)
+        self.failUnless(time.time()-start < 1)
+
+        cache = maroon.ThreadSafeModelCache(SimpleModel, batch_window=0.05)
+        results = {}
+        def look(n,key):
+            results[n] = cache[key]
+        slow = threading.Thread(target=look, args=(9,3))
+        slow.start()
+        loading.wait()
+        #these misses come while 3 is loading, so they are batched
+        threads = [ threading.Thread(target=look, args=(n,n%3))
+                for n in xrange(9)]
+        for t in threads:
+            t.start()
+        for t in threads+[slow]:
+            t.join()
+        self.failUnlessEqual(calls, [[0,1,2]])
+        self.failUnlessEqual([results[n].int1 for n in xrange(10)],
+                [0,1,2]*3+[3])
+        self.failUnlessEqual(cache.stats()['coalesced'], 6)
+
+    def test_buffered(self):
+        db = maroon.Model.database
+        bulk = []
+        def bulk_save_models(models, cls=None):
+            if any(m.int1==13 for m in models):
+                raise ValueError("unlucky")
+            bulk.append(len(models))
+            MockDB.bulk_save_models(db, models, cls)
+        def save(model):
+            if model.int1==13:
+                raise ValueError("unlucky")
+            return MockDB.save(db, model)
+        db.bulk_save_models = bulk_save_models
+        db.save = save
+        with BufferedDB(db, size=4) as maroon.Model.database:
+            for i in xrange(6):
+                SimpleModel(_id=i, int1=i).save()
+            self.failUnlessEqual(bulk, [4])
+            SimpleModel.get_id(0).delete()
+            SimpleModel(_id=7, int1=7).save()
+        self.failUnlessEqual(bulk, [4,2,1])
+        self.failUnlessEqual(sorted(db.data['SimpleModel']), [1,2,3,4,5,7])
+        buf = BufferedDB(db)
+        buf.bulk_save_models([SimpleModel(_id=i, int1=i) for i in (12,13,14)])
+        try:
+            buf.flush()
+        except BufferedSaveError, e:
+            self.failUnlessEqual([m._id for m,err in e.errors], [13])
+        else:
+            self.fail("flush should raise BufferedSaveError")
+        self.failUnless( 14 in db.data['SimpleModel'] )
+
+        #the model is written as it was when it was saved, and it stays
+        #dirty until the write goes through
+        buf = BufferedDB(db)
+        maroon.Model.database = buf
+        later = SimpleModel.get_id(14)
+        later.int2 = 1
+        later.save()
+        later.int2 = 2
+        self.failUnlessEqual(later.changed(), set(['int2']))
+        buf.flush()
+        self.failUnlessEqual(db.data['SimpleModel'][14].int2, 1)
+        self.failUnlessEqual(later.changed(), set(['int2']))
+        saved = SimpleModel.get_id(4)
+        saved.int2 = 3
+        saved.save()
+        buf.flush()
+        self.failUnlessEqual(saved.changed(), set())
+        self.failUnlessEqual(db.data['SimpleModel'][4].to_d(),
+                {'_id':4, 'i1':4, 'i2':3})
+        unlucky = SimpleModel(_id=13, int1=13)
+        unlucky.save()
+        self.assertRaises(BufferedSaveError, buf.flush)
+        self.failUnlessEqual(unlucky.changed(), None)
+        maroon.Model.database = db
+
+        #the interval is checked when a write comes in
+        now = [0]
+        buf = BufferedDB(db, interval=5, clock=lambda: now[0])
+        buf.save(SimpleModel(_id=20, int1=20))
+        now[0] = 6
+        self.failIf( 20 in db.data['SimpleModel'] )
+        buf.save(SimpleModel(_id=21, int1=21))
+        self.failUnless( 21 in db.data['SimpleModel'] )
+        self.failUnlessEqual(buf._ops, [])
+
+    def test_bulk_generator(self):
+        path = tempfile.mkdtemp()+"/log"
+        maroon.Model.database = TeeDB(path, maroon.Model.database)
+        SimpleModel.bulk_save(SimpleModel(int1=i) for i in xrange(5))
+        self.failUnlessEqual(len(open(path).readlines()), 5)
+        self.failUnlessEqual(len(SimpleModel.find(SimpleModel.int1>=0)), 5)
+        os.remove(path)
+        os.removedirs(path.rpartition('/')[0])
+
+    def test_pipeline(self):
+        read = []
+        def chunks():
+            for chunk in maroondb._chunks(xrange(10), 3):
+                read.append(chunk)
+                yield chunk
+        res = maroondb._pipeline(sum, chunks(), workers=2)
+        self.failUnlessEqual(res.next(), 3)
+        #the pipeline only reads one chunk past the ones in flight
+        self.failUnlessEqual(len(read), 3)
+        self.failUnlessEqual(list(res), [12,21,9])
+
+    def test_prefetch(self):
+        read = []
+        def pages():
+            for page in maroondb._chunks(xrange(10), 3):
+                read.append(page)
+                yield page
+        res = maroondb._prefetch(pages(), depth=2)
+        self.failUnlessEqual(res.next(), [0,1,2])
+        self.failUnlessEqual(list(res), [[3,4,5],[6,7,8],[9]])
+        def broken():
+            yield 1
+            raise ValueError("network is down")
+        res = maroondb._prefetch(broken())
+        self.failUnlessEqual(res.next(), 1)
+        self.failUnlessRaises(ValueError, res.next)
+        #the reader stops when the consumer does
+        read = []
+        res = maroondb._prefetch(pages(), depth=1)
+        res.next()
+        res.close()
+        time.sleep(.3)
+        self.failUnless(len(read) <= 3)
+
+    def test_interleave(self):
+        scans = [
+            lambda: iter(xrange(0,50)),
+            lambda: iter(xrange(50,70)),
+            lambda: iter(xrange(70,100)),
+            ]
+        res = maroondb._interleave(scans, workers=2, depth=5)
+        self.failUnlessEqual(sorted(res), range(100))
+        def broken():
+            yield 1
+            raise ValueError("network is down")
+        res = maroondb._interleave([broken, scans[0]], workers=2)
+        self.failUnlessRaises(ValueError, list, res)
+        self.failUnlessEqual(maroondb._ranges([3,7]),
+                [(None,3),(3,7),(7,None)])
+        for age in xrange(5):
+            PersonModel(_id='scan%d'%age, age=age).save()
+        res = PersonModel.parallel_scan(PersonModel.age<3, workers=2)
+        self.failUnlessEqual(sorted(p.age for p in res), [0,1,2])
+
+    def test_map_results(self):
+        for age in xrange(30):
+            PersonModel(_id='map%d'%age, age=age).save()
+        q = PersonModel._id.is_in(['map%d'%age for age in xrange(30)])
+        res = PersonModel.map_results(q, _age, processes=2, chunk=4,
+                sort=PersonModel.age)
+        self.failUnlessEqual(list(res), range(30))
+        res = PersonModel.map_results(q, _age, processes=2, chunk=4,
+                ordered=False)
+        self.failUnlessEqual(sorted(res), range(30))
+        total = PersonModel.map_results(q, _age, processes=2,
+                reducer=lambda a,b: a+b)
+        self.failUnlessEqual(total, sum(range(30)))
+        PersonModel(_id='map7', age=-1).save()
+        res = PersonModel.map_results(q, _age, processes=2, chunk=4)
+        self.failUnlessRaises(ValueError, list, res)
+
+    def test_async(self):
+        db = AsyncDB(maroon.Model.database, workers=2, prefetch=2)
+        maroon.Model.database = db
+        with db:
+            person = PersonModel(_id='async', name='sam', age=3)
+            self.failUnlessEqual(person.asave().get(), person)
+            self.failUnless(PersonModel.ain_db('async').get())
+            self.failUnlessEqual(PersonModel.aget_id('async').get().name, 'sam')
+            saving = PersonModel.abulk_save(
+                    PersonModel(_id='async%d'%x, age=30+x) for x in xrange(5))
+            saving.get()
+            res = PersonModel.afind(PersonModel.age>=30, sort=PersonModel.age)
+            self.failUnlessEqual([p.age for p in res], range(30,35))
+            PersonModel(_id='async', age=4).amerge().get()
+            self.failUnlessEqual(PersonModel.get_id('async').name, 'sam')
+            self.failUnlessEqual(PersonModel.get_id('async').age, 4)
+            self.failUnlessRaises(ValueError, db.run(int, 'seven').get)
+
+    def test_pooled(self):
+        mock = maroon.Model.database
+        made = []
+        def factory():
+            made.append(MockDB())
+            made[-1].data = mock.data
+            return made[-1]
+        pool = PooledDB(factory, size=2, timeout=.05)
+        path = tempfile.mktemp()
+        maroon.Model.database = TeeDB(path, pool)
+        PersonModel(_id='pooled', name='pat').save()
+        self.failUnlessEqual(PersonModel.get_id('pooled').name, 'pat')
+        seen = []
+        def work():
+            with pool.bound() as db:
+                seen.append(db)
+                PersonModel(_id='pooled2', name='lee').save()
+                self.failUnless(pool.current() is db)
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.failUnlessEqual(len(made), 2)
+        self.failUnless(seen[0] is made[1])
+        self.failUnlessEqual(pool.stats()['idle'], 1)
+        #the main thread and the other one logged their saves
+        with open(path) as f:
+            self.failUnlessEqual(
+                [json.loads(line)['n'] for line in f], ['pat','lee'])
+        os.remove(path)
+        #both databases are in use, so a third thread can't get one
+        held = pool.checkout()
+        self.failUnlessRaises(PoolTimeout, pool.checkout)
+        pool.checkin(held)
+        pool.release()
+        stats = pool.stats()
+        self.failUnlessEqual((stats['idle'], stats['timeouts']), (2, 1))
+        #unhealthy databases are replaced
+        pool = PooledDB(factory, size=1, check=lambda db: False,
+                check_after=0)
+        pool.checkin(pool.checkout())
+        pool.checkout()
+        self.failUnlessEqual(pool.stats()['discarded'], 1)
+
+    def test_index(self):
+        db = maroon.Model.database
+        db.ensure_index(PersonModel, PersonModel.age)
+        db.ensure_index(PersonModel, PersonModel.age, ordered=True)
+        db.ensure_index(PersonModel, PersonModel.age)
+        #a hash index is upgraded, and an ordered one is never downgraded
+        self.failUnless(isinstance(db.indexes['PersonModel']['a'],
+                mock._SortedIndex))
+        db.ensure_index(PersonModel, PersonModel.name)
+        for age in xrange(10,20):
+            PersonModel(_id=age, name="p%d"%age, age=age).save()
+        q = (PersonModel.age>=12) & (PersonModel.name.is_in(['p11','p15']))
+        self.failUnlessEqual(db._plan(PersonModel, q.to_mongo_dict())[0], 2)
+        self.failUnlessEqual([15], [p.age for p in PersonModel.find(q)])
+        #the ordered index still answers $in
+        q = PersonModel.age.is_in([11,14,40,None])
+        self.failUnlessEqual(db._plan(PersonModel, q.to_mongo_dict())[0], 2)
+        self.failUnlessEqual([11,14],
+                sorted(p.age for p in PersonModel.find(q)))
+        res = PersonModel.find(sort=PersonModel.age, desc=True, limit=3)
+        self.failUnlessEqual([19,18,17], [p.age for p in res])
+        PersonModel(_id=19, name="p19", age=1).save()
+        PersonModel.get_id(18).delete()
+        res = PersonModel.find(PersonModel.age<12, sort=PersonModel.age)
+        self.failUnlessEqual([1,3,7,10,11], [p.age for p in res])
+        res = PersonModel.find(sort=PersonModel.age, desc=True, limit=2)
+        self.failUnlessEqual([17,16], [p.age for p in res])
+
+
+class _CouchStub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    "just enough of the CouchDB http api for the maroon calls, in memory"
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1',0), _CouchHandler)
+        self.docs = {}
+        self.lock = threading.Lock()
+        self.requests = []
+
+
+class _CouchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        url = urlparse.urlparse(self.path)
+        parts = url.path.strip('/').split('/',1)
+        params = dict((k,json.loads(v))
+            for k,v in urlparse.parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        with self.server.lock:
+            self.server.requests.append((self.command, url.path))
+            return self._handle(parts[1] if len(parts)>1 else '', params, body)
+
+    def _handle(self, path, params, body):
+        docs = self.server.docs
+        if path=='':
+            return 200, dict(db_name='test', doc_count=len(docs))
+        if path=='_all_docs':
+            if body and 'keys' in body:
+                keys = body['keys']
+            else:
+                keys = sorted(docs)
+                if 'startkey' in params:
+                    keys = [k for k in keys if k>=params['startkey']]
+                keys = keys[params.get('skip',0):]
+                if 'limit' in params:
+                    keys = keys[:params['limit']]
+            rows = []
+            for key in keys:
+                if key not in docs:
+                    rows.append(dict(key=key, error='not_found'))
+                    continue
+                row = dict(id=key, key=key, value=dict(rev=docs[key]['_rev']))
+                if params.get('include_docs'):
+                    row['doc'] = docs[key]
+                rows.append(row)
+            return 200, dict(total_rows=len(docs), offset=0, rows=rows)
+        if path=='_bulk_docs':
+            return 201, [self._put(d['_id'], d)[1] for d in body['docs']]
+        if self.command=='GET':
+            if path in docs:
+                return 200, docs[path]
+            return 404, dict(error='not_found', reason='missing')
+        if self.command=='PUT':
+            return self._put(urlparse.unquote(path), body)
+        return 405, dict(error='method_not_allowed')
+
+    def _put(self, _id, doc):
+        old = self.server.docs.get(_id)
+        if old is not None and old['_rev']!=doc.get('_rev'):
+            return 409, dict(id=_id, error='conflict', reason='update conflict')
+        rev = int(old['_rev'].split('-')[0])+1 if old else 1
+        doc = dict(doc, _id=_id, _rev='%d-stub'%rev)
+        self.server.docs[_id] = doc
+        return 201, dict(ok=True, id=_id, rev=doc['_rev'])
+
+    def _serve(self):
+        self._reply(*self._route())
+
+    do_GET = do_PUT = do_POST = do_HEAD = _serve
+
+
+class TestAsyncCouch(unittest.TestCase):
+    "runs AsyncDB over a CouchDB that talks to a stub http server"
+    def setUp(self):
+        self.server = _CouchStub()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%d/test_maroon'%self.server.server_port
+        self.db = AsyncDB(CouchDB(url), workers=2, prefetch=2)
+        self.old_database = PersonModel.__dict__.get('database')
+        PersonModel.database = self.db
+
+    def tearDown(self):
+        self.db.close()
+        self.server.shutdown()
+        self.server.server_close()
+        if self.old_database is None:
+            del PersonModel.database
+        else:
+            PersonModel.database = self.old_database
+
+    def test_async(self):
+        person = PersonModel(_id='async', name='sam', age=3)
+        self.failUnlessEqual(person.asave().get(), person)
+        self.failUnlessEqual(person._rev, '1-stub')
+        self.failUnlessEqual(PersonModel.aget_id('async').get().name, 'sam')
+        self.failUnlessEqual(PersonModel.aget_id('nobody').get(), None)
+        PersonModel.abulk_save(
+            PersonModel(_id='async%d'%x, age=30+x) for x in xrange(5)).get()
+        self.failUnlessEqual(
+            sorted(p.age for p in PersonModel.get_ids(['async1','async3'])),
+            [31,33])
+        PersonModel(_id='async', age=4).amerge().get()
+        sam = PersonModel.get_id('async')
+        self.failUnlessEqual((sam.name, sam.age, sam._rev), ('sam',4,'2-stub'))
+        #couch can not run queries, but get_all pages through _all_docs
+        res = self.db.run(lambda: list(PersonModel.get_all())).get()
+        self.failUnlessEqual(sorted(p._id for p in res),
+            ['async']+['async%d'%x for x in xrange(5)])
+        self.failUnless(self.db.healthy())
+        self.failUnless(('POST','/test_maroon/_bulk_docs')
+            in self.server.requests)
+
+    def test_ordered_bulk_save(self):
+        PersonModel(_id='b1', age=1).save()
+        people = [PersonModel(_id='b%d'%x, age=x) for x in xrange(10)]
+        self.failUnlessRaises(couchdbkit.BulkSaveError, PersonModel.bulk_save,
+            people, chunk_size=2, workers=4)
+        #the chunks after the one that failed are not sent
+        self.failUnlessEqual(sorted(self.server.docs), ['b0','b1'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -29,3 +29,13 @@ class FunModel(Model):
     created = CreatedAtProperty("ca")
     names = ListProperty("ns", basestring)
     part = ModelProperty("me", PersonModel)
+
+
+class PointModel(Model):
+    '''
+    A compact model keeps its fields in __slots__.
+    '''
+    compact = True
+    x = IntProperty("x")
+    y = IntProperty("y", default=0)
+    when = DateTimeProperty("w")
@@ -116,6 +116,13 @@ class TestQueries(unittest.TestCase):
         self.failUnlessEqual( [6], _query_to_list(
             factors.has_all([2,3]) ))
 
+    def test_find_columns(self):
+        n = NumberModel.n
+        cols = NumberModel.find_columns(n>7, fields=[n, NumberModel.quad],
+                sort=n)
+        self.failUnlessEqual(cols['n'].tolist(), [8,9,10])
+        self.failUnlessEqual(cols['quad'].tolist(), [9,16,25])
+
     def test_range(self):
         n = NumberModel.n
         self.failUnlessEqual(range(11), _query_to_list(n.range()))
@@ -155,6 +162,10 @@ if __name__ == '__main__':
         Model.database.NumberModel.remove()
     elif db=='mock':
         Model.database = MockDB(None)
+    elif db=='mockindex':
+        Model.database = MockDB(None)
+        Model.database.ensure_index(NumberModel, NumberModel.n, ordered=True)
+        Model.database.ensure_index(NumberModel, NumberModel.factors)
     _number_set_up()
     del sys.argv[1]
     unittest.main()